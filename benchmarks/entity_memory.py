@@ -0,0 +1,63 @@
+"""
+Память на одно преобразованное сообщение (личка, пользователь, чат, одно вложение).
+Запуск: python -m benchmarks.entity_memory [количество сообщений]
+"""
+import datetime
+import sys
+import tracemalloc
+
+from interfaces.base import types
+
+PLATFORM = "Benchmark"
+
+
+class BenchmarkUser(types.User):
+    __slots__ = ()
+
+
+class BenchmarkChat(types.Chat):
+    __slots__ = ()
+
+
+class BenchmarkPhoto(types.Photo):
+    __slots__ = ()
+
+    async def get(self):
+        return b""
+
+
+class BenchmarkMessage(types.Message):
+    __slots__ = ()
+
+    async def reply(self, text, attachments=None):
+        pass
+
+    async def answer(self, text, attachments=None):
+        pass
+
+    async def edit(self, text, attachments=None):
+        pass
+
+
+def build_message(n: int) -> types.Message:
+    user = BenchmarkUser(id=n, platform=PLATFORM, first_name="Имя", last_name="", username=f"user{n}", is_bot=False)
+    chat = BenchmarkChat(id=n, platform=PLATFORM, type=types.ChatType.PRIVATE, title="Имя", members=[user])
+    photo = BenchmarkPhoto(id=n, file_name="image.jpg", file_size=1024)
+    return BenchmarkMessage(id=n, from_user=user, chat=chat, date=datetime.datetime.now(), text=f"сообщение {n}",
+                            attachments=[photo])
+
+
+def measure(count: int) -> float:
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    messages = [build_message(n) for n in range(count)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    del messages
+    return size / count
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    print(f"{measure(count):.0f} байт на сообщение ({count} сообщений)")
@@ -0,0 +1,143 @@
+"""
+Заменитель TelegramClient для замеров без сети: те же методы, что использует interfaces/telegram,
+ответы собираются из настоящих TL-объектов Telethon, задержка каждого запроса настраивается.
+"""
+import asyncio
+import datetime
+import itertools
+from typing import Any, AsyncIterator, Iterable, Optional
+
+import telethon
+from telethon.tl.functions.messages import GetStickerSetRequest
+from telethon.tl.patched import Message
+
+DATE = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+PHOTO_SIZE = 64 * 1024
+
+
+def make_user(id: int) -> telethon.types.User:
+    return telethon.types.User(id=id, access_hash=id, first_name=f"Имя {id}", last_name=None, username=f"user{id}",
+                               bot=False)
+
+
+def make_photo(id: int, size: int = PHOTO_SIZE) -> telethon.types.Photo:
+    return telethon.types.Photo(id=id, access_hash=id, file_reference=b"", date=DATE, dc_id=2,
+                                sizes=[telethon.types.PhotoSize(type="x", w=800, h=600, size=size)])
+
+
+def make_message(id: int, user_id: int, text: str, photo: bool = False) -> Message:
+    return Message(
+        id=id,
+        peer_id=telethon.types.PeerUser(user_id),
+        date=DATE,
+        message=text,
+        media=telethon.types.MessageMediaPhoto(photo=make_photo(id)) if photo else None,
+    )
+
+
+class FakeTelegramClient:
+    def __init__(self, latency: float = 0.0, download_latency: float = None, file_size: int = PHOTO_SIZE):
+        """
+        :param latency: Задержка каждого запроса к "API" в секундах
+        :param download_latency: Задержка скачивания файла, по умолчанию как latency
+        :param file_size: Размер "скачиваемых" файлов
+        """
+        self.latency = latency
+        self.download_latency = latency if download_latency is None else download_latency
+        self.file_size = file_size
+        self.requests = 0
+        self.sent: list[tuple[int, str]] = []
+        self.handlers = []
+        self._ids = itertools.count(1_000_000)
+
+    async def _request(self, latency: float = None):
+        self.requests += 1
+        latency = self.latency if latency is None else latency
+        if latency:
+            await asyncio.sleep(latency)
+
+    # Запуск
+
+    async def start(self, *args, **kwargs):
+        await self._request()
+        return self
+
+    def add_event_handler(self, callback, event=None):
+        self.handlers.append(callback)
+
+    def remove_event_handler(self, callback, event=None) -> int:
+        count = self.handlers.count(callback)
+        self.handlers = [handler for handler in self.handlers if handler != callback]
+        return count
+
+    async def run_until_disconnected(self):
+        await asyncio.Event().wait()
+
+    async def disconnect(self):
+        pass
+
+    # Запросы
+
+    async def get_entity(self, entity: int | Iterable[int]) -> Any:
+        await self._request()
+        if isinstance(entity, int):
+            return make_user(entity)
+        return [make_user(id) for id in entity]
+
+    async def get_messages(self, chat: int, limit: int = 100, add_offset: int = 0, ids: int = None) -> Any:
+        await self._request()
+        if ids is not None:
+            return make_message(ids, chat, f"сообщение {ids}")
+        return [make_message(n, chat, f"сообщение {n}") for n in range(add_offset, add_offset + limit)]
+
+    async def __call__(self, request: Any) -> Any:
+        await self._request()
+        if isinstance(request, GetStickerSetRequest):
+            sticker_set = request.stickerset
+            return telethon.types.messages.StickerSet(
+                set=telethon.types.StickerSet(id=sticker_set.id, access_hash=sticker_set.access_hash,
+                                              title="Набор", short_name="set", count=0, hash=0),
+                packs=[], keywords=[], documents=[],
+            )
+        raise NotImplementedError(type(request).__name__)
+
+    # Отправка
+
+    def _sent(self, chat: int, text: str, media: Any = None) -> Message:
+        self.sent.append((chat, text))
+        return make_message(next(self._ids), chat, text) if media is None else Message(
+            id=next(self._ids), peer_id=telethon.types.PeerUser(chat), date=DATE, message=text, media=media)
+
+    async def send_message(self, entity: int, message: str = "", reply_to: int = None, **kwargs) -> Message:
+        await self._request()
+        return self._sent(entity, message)
+
+    async def send_file(self, entity: int, file: Any, caption: str = "", reply_to: int = None, **kwargs) -> Any:
+        await self._request()
+        files = file if isinstance(file, list) else [file]
+        messages = [self._sent(entity, caption, telethon.types.MessageMediaPhoto(photo=make_photo(next(self._ids))))
+                    for _ in files]
+        return messages if isinstance(file, list) else messages[0]
+
+    async def edit_message(self, entity: int, message: int, text: str = None, **kwargs) -> Message:
+        await self._request()
+        return make_message(message, entity, text)
+
+    # Файлы
+
+    async def upload_file(self, file: bytes, file_name: str = None, **kwargs) -> telethon.types.InputFile:
+        await self._request()
+        return telethon.types.InputFile(id=next(self._ids), parts=1, name=file_name or "file", md5_checksum="")
+
+    async def download_media(self, message: Any, file: Any = None, **kwargs) -> Optional[bytes]:
+        await self._request(self.download_latency)
+        return bytes(self.file_size)
+
+    async def iter_download(self, file: Any, offset: int = 0, request_size: int = 128 * 1024,
+                            file_size: int = None, **kwargs) -> AsyncIterator[bytes]:
+        size = file_size or self.file_size
+        while offset < size:
+            await self._request(self.download_latency)
+            chunk = min(request_size, size - offset)
+            offset += chunk
+            yield bytes(chunk)
@@ -0,0 +1,129 @@
+"""
+Пропускная способность и задержки конвейера Telegram без сети: transform и BaseInterface.message_handler
+на FakeTelegramClient. Завершается с кодом 1, если результат хуже порогов THRESHOLDS.
+Запуск: python -m benchmarks.pipeline [--count N] [--latency секунды] [--no-check]
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+import tracemalloc
+
+from interfaces.base import BaseInterface
+from interfaces.telegram import TelegramInterface
+
+from .fake_client import FakeTelegramClient, make_message, make_user
+
+USERS = 100
+
+# Пороги регрессии: (минимум или максимум, значение)
+THRESHOLDS = {
+    "transform_per_sec": ("min", 5000.0),
+    "handler_per_sec": ("min", 2000.0),
+    "bytes_per_message": ("max", 4096.0),
+    "handler_p50_ms": ("max", 1.0),
+    "handler_p99_ms": ("max", 10.0),
+}
+
+
+class BenchmarkInterface(TelegramInterface):
+    # Замеряем свой код, а не ограничение частоты отправки
+    send_rate = 1e9
+    chat_send_rate = 1e9
+
+
+def build_tl_messages(count: int, text: str = None) -> list:
+    # Каждое второе - с фото, чтобы в замер попали вложения
+    return [make_message(n, n % USERS, text or f"сообщение {n}", photo=n % 2 == 0) for n in range(count)]
+
+
+def make_interface(base: BaseInterface, client: FakeTelegramClient, **kwargs) -> BenchmarkInterface:
+    interface = BenchmarkInterface(base, client=client, **kwargs)
+    # Пользователи уже в кэше, как у работающего бота - замеряется преобразование, а не первый запрос
+    for id in range(USERS):
+        interface.entity_cache.set(id, make_user(id))
+    return interface
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def measure(count: int, latency: float) -> dict[str, float]:
+    base = BaseInterface(None)
+    client = FakeTelegramClient(latency=latency)
+    interface = make_interface(base, client)
+    results = {}
+
+    tl_messages = build_tl_messages(count)
+    started = time.perf_counter()
+    for tl in tl_messages:
+        await interface.transform(tl)
+    results["transform_per_sec"] = count / (time.perf_counter() - started)
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    messages = [await interface.transform(tl) for tl in tl_messages]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    results["bytes_per_message"] = sum(stat.size_diff for stat in after.compare_to(before, "filename")) / count
+    del messages
+
+    # Ответ через source (patched Message.reply) требует сессии настоящего клиента,
+    # без source TelegramMessage отвечает через client.send_message
+    await interface.stop()
+    interface = make_interface(base, client, keep_source=False)
+
+    # Задержка одного сообщения: обработчик, команда и ответ через очередь отправки
+    commands = [await interface.transform(tl) for tl in build_tl_messages(count, "/echo тест")]
+    latencies = []
+    for message in commands:
+        started = time.perf_counter()
+        await base.message_handler(message)
+        latencies.append((time.perf_counter() - started) * 1000)
+    results["handler_p50_ms"] = statistics.median(latencies)
+    results["handler_p99_ms"] = percentile(latencies, 0.99)
+
+    # Пропускная способность через диспетчер, как при работе бота
+    commands = [await interface.transform(tl) for tl in build_tl_messages(count, "/echo тест")]
+    started = time.perf_counter()
+    for message in commands:
+        await base.dispatch(message)
+    await base.dispatcher.join()
+    results["handler_per_sec"] = count / (time.perf_counter() - started)
+
+    await base.dispatcher.close()
+    await interface.stop()
+    return results
+
+
+def check(results: dict[str, float]) -> list[str]:
+    failures = []
+    for name, (kind, limit) in THRESHOLDS.items():
+        value = results[name]
+        if kind == "min" and value < limit or kind == "max" and value > limit:
+            failures.append(f"{name} = {value:.2f}, порог {kind} {limit}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=5000, help="Сообщений в каждом замере")
+    parser.add_argument("--latency", type=float, default=0.0, help="Задержка запроса фейкового клиента, секунды")
+    parser.add_argument("--no-check", action="store_true", help="Не сравнивать с порогами")
+    args = parser.parse_args()
+
+    results = asyncio.run(measure(args.count, args.latency))
+    for name, value in results.items():
+        print(f"{name:<20} {value:>12.2f}")
+
+    failures = [] if args.no_check else check(results)
+    for failure in failures:
+        print("Регрессия:", failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1 +1,14 @@
+from .broadcast import BroadcastReport
+from .cache import TTLCache
+from .commands import CommandRegistry, command
+from .dispatcher import Dispatcher
+from .downloads import DownloadManager
+from .media_store import MediaStore
+from .registry import ConversionRegistry
+from .sender import SendScheduler, Priority
+from .sharding import ShardedDispatcher
+from .state import StateStore
+from .storage import Storage
+from .supervisor import Supervisor, Health
+from .tracing import Tracer, tracer
 from .interface import Interface, BaseInterface
@@ -0,0 +1,127 @@
+import asyncio
+import logging
+from typing import AsyncIterable, AsyncIterator, Awaitable, Callable, Iterable, Optional
+
+BROADCAST_CONCURRENCY = 16
+
+
+class BroadcastResult:
+    __slots__ = ("id", "ok", "error")
+
+    def __init__(self, id: int, ok: bool, error: Optional[str] = None):
+        """
+        Результат отправки одному получателю.
+        :param id: ID получателя
+        :param ok: Успешно ли
+        :param error: Текст ошибки
+        """
+        self.id = id
+        self.ok = ok
+        self.error = error
+
+    def __repr__(self):
+        return f"BroadcastResult(id={self.id!r}, ok={self.ok!r}, error={self.error!r})"
+
+
+class BroadcastReport:
+    def __init__(self):
+        self.results: list[BroadcastResult] = []
+        self.sent = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def add(self, result: BroadcastResult):
+        self.results.append(result)
+        if result.ok:
+            self.sent += 1
+        else:
+            self.failed += 1
+
+    def __str__(self):
+        return f"Отправлено: {self.sent}, ошибок: {self.failed}, пропущено: {self.skipped}"
+
+
+class Checkpoint:
+    def __init__(self, path: str):
+        """
+        Файл с уже обработанными получателями рассылки, строка "ID<tab>ok" или "ID<tab>ошибка".
+        При повторном запуске успешно получившие сообщение пропускаются.
+        :param path: Путь к файлу
+        """
+        self.path = path
+        self.done: set[int] = set()
+        try:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    id, _, status = line.rstrip("\n").partition("\t")
+                    if status == "ok":
+                        self.done.add(int(id))
+        except FileNotFoundError:
+            pass
+        self._file = open(path, "a", encoding="utf-8")
+
+    def __contains__(self, id: int):
+        return id in self.done
+
+    def record(self, result: BroadcastResult):
+        error = (result.error or "error").replace("\n", " ").replace("\t", " ")
+        self._file.write(f"{result.id}\t{'ok' if result.ok else error}\n")
+        self._file.flush()
+        if result.ok:
+            self.done.add(result.id)
+
+    def close(self):
+        self._file.close()
+
+
+async def _aiter(ids: Iterable[int] | AsyncIterable[int]) -> AsyncIterator[int]:
+    if hasattr(ids, "__aiter__"):
+        async for id in ids:
+            yield id
+    else:
+        for id in ids:
+            yield id
+
+
+async def broadcast(send: Callable[[int], Awaitable], ids: Iterable[int] | AsyncIterable[int],
+                    concurrency: int = BROADCAST_CONCURRENCY, checkpoint: str = None) -> BroadcastReport:
+    """
+    Отправляет всем получателям из ids, читая их по мере отправки.
+    :param send: Отправка одному получателю по ID
+    :param ids: Получатели, обычный или асинхронный итератор
+    :param concurrency: Сколько отправок выполняется одновременно
+    :param checkpoint: Файл прогресса, чтобы продолжить прерванную рассылку
+    """
+    report = BroadcastReport()
+    saved = Checkpoint(checkpoint) if checkpoint else None
+    recipients = _aiter(ids)
+    # Асинхронный генератор нельзя читать из нескольких задач одновременно
+    lock = asyncio.Lock()
+
+    async def worker():
+        while True:
+            async with lock:
+                try:
+                    id = await anext(recipients)
+                except StopAsyncIteration:
+                    return
+            if saved and id in saved:
+                report.skipped += 1
+                continue
+
+            try:
+                await send(id)
+                result = BroadcastResult(id, True)
+            except Exception as e:
+                logging.warning("Рассылка: не удалось отправить %s: %s", id, e)
+                result = BroadcastResult(id, False, str(e))
+            report.add(result)
+            if saved:
+                saved.record(result)
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    finally:
+        if saved:
+            saved.close()
+    return report
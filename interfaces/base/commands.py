@@ -0,0 +1,147 @@
+import inspect
+from typing import Any, Callable, Iterator, Optional
+
+COMMAND_ATTR = "__command__"
+
+
+def command(name: str = None, aliases: tuple[str, ...] = (), description: str = None,
+            **converters: Callable[[str], Any]):
+    """
+    Помечает метод как команду бота.
+    :param name: Имя команды, по умолчанию имя метода
+    :param aliases: Другие имена команды
+    :param description: Описание для /help, по умолчанию первая строка docstring
+    :param converters: Преобразователи аргументов по имени параметра, по умолчанию берутся из аннотаций
+    """
+
+    def decorator(func):
+        setattr(func, COMMAND_ATTR, {
+            "name": name or func.__name__,
+            "aliases": tuple(aliases),
+            "description": description,
+            "converters": converters,
+        })
+        return func
+
+    return decorator
+
+
+class Command:
+    def __init__(self, func: Callable, name: str, aliases: tuple[str, ...] = (), description: str = None,
+                 converters: dict[str, Callable[[str], Any]] = None):
+        """
+        Команда с заранее разобранной сигнатурой.
+        :param func: Связанный метод вида func(message, *args)
+        :param name: Имя команды
+        :param aliases: Другие имена команды
+        :param description: Описание команды
+        :param converters: Преобразователи аргументов по имени параметра
+        """
+        self.func = func
+        self.name = name
+        self.aliases = aliases
+        self.description = description or (inspect.getdoc(func) or "").split("\n")[0]
+        converters = converters or {}
+
+        # Первый параметр - сообщение, остальные - аргументы команды
+        params = list(inspect.signature(func).parameters.values())[1:]
+        self.arity = 0
+        self.max_args: Optional[int] = 0
+        self.converters: list[Optional[Callable[[str], Any]]] = []
+        self.rest_converter: Optional[Callable[[str], Any]] = None
+        for param in params:
+            converter = converters.get(param.name)
+            if converter is None and param.annotation in (int, float):
+                converter = param.annotation
+
+            if param.kind == param.VAR_POSITIONAL:
+                self.max_args = None
+                self.rest_converter = converter
+            elif param.kind in (param.POSITIONAL_ONLY, param.POSITIONAL_OR_KEYWORD):
+                self.converters.append(converter)
+                self.max_args += 1
+                if param.default is param.empty:
+                    self.arity += 1
+
+    @property
+    def usage(self) -> str:
+        return f"/{self.name}" + (f" ({', '.join(self.aliases)})" if self.aliases else "")
+
+    def convert(self, args: list[str]) -> list[Any]:
+        if len(args) < self.arity:
+            raise ValueError(
+                f"Недостаточно аргументов. Ожидалось как минимум: {self.arity}, получено: {len(args)}")
+        if self.max_args is not None and len(args) > self.max_args:
+            raise ValueError(f"Слишком много аргументов. Ожидалось не более: {self.max_args}, получено: {len(args)}")
+
+        result = []
+        for index, arg in enumerate(args):
+            converter = self.converters[index] if index < len(self.converters) else self.rest_converter
+            if converter is None:
+                result.append(arg)
+                continue
+            try:
+                result.append(converter(arg))
+            except (TypeError, ValueError):
+                raise ValueError(f"Неверный аргумент №{index + 1}: {arg!r}")
+        return result
+
+    async def __call__(self, message, args: list[str]):
+        return await self.func(message, *self.convert(args))
+
+
+class CommandRegistry:
+    def __init__(self):
+        """
+        Реестр команд. Поиск по точному имени - словарь, по однозначному префиксу - префиксное дерево.
+        """
+        self._commands: dict[str, Command] = {}
+        self._trie: dict[str, Any] = {}
+
+    @classmethod
+    def from_object(cls, obj: object) -> "CommandRegistry":
+        """
+        Собирает реестр из методов объекта, помеченных декоратором command.
+        """
+        registry = cls()
+        for attr in dir(type(obj)):
+            meta = getattr(getattr(type(obj), attr), COMMAND_ATTR, None)
+            if meta is not None:
+                registry.add(Command(getattr(obj, attr), **meta))
+        return registry
+
+    def add(self, cmd: Command):
+        for name in (cmd.name, *cmd.aliases):
+            if name in self._commands:
+                raise ValueError(f"Команда {name!r} уже зарегистрирована")
+            self._commands[name] = cmd
+
+            node = self._trie
+            for char in name:
+                node = node.setdefault(char, {})
+                node.setdefault("", set()).add(cmd.name)
+
+    def find(self, name: str) -> Optional[Command]:
+        cmd = self._commands.get(name)
+        if cmd is not None or not name:
+            return cmd
+
+        node = self._trie
+        for char in name:
+            node = node.get(char)
+            if node is None:
+                return None
+        names = node[""]
+        if len(names) == 1:
+            return self._commands[next(iter(names))]
+        return None
+
+    def __contains__(self, name: str):
+        return self.find(name) is not None
+
+    def __iter__(self) -> Iterator[Command]:
+        # Каждая команда один раз, без псевдонимов
+        return iter(sorted({cmd.name: cmd for cmd in self._commands.values()}.values(), key=lambda c: c.name))
+
+    def help(self) -> str:
+        return "\n".join(f"{cmd.usage} - {cmd.description}" if cmd.description else cmd.usage for cmd in self)
@@ -0,0 +1,112 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Hashable, Optional
+
+from .types import Message
+
+WORKERS = 8
+MAX_PENDING = 1024
+
+
+class Dispatcher:
+    def __init__(self, handler: Callable[[Message], Awaitable], workers: int = WORKERS,
+                 max_pending: int = MAX_PENDING):
+        """
+        Распределяет сообщения по ограниченному числу обработчиков.
+        Сообщения одного чата обрабатываются строго по очереди, разные чаты - параллельно и по кругу.
+        :param handler: Обработчик сообщения
+        :param workers: Количество одновременно работающих обработчиков
+        :param max_pending: Максимум ожидающих сообщений, после которого submit ждёт освобождения места
+        """
+        self.handler = handler
+        self.workers = workers
+        self.max_pending = max_pending
+        self.processed = 0
+        self.failed = 0
+        self._queues: dict[Hashable, deque[Message]] = {}
+        self._ready: asyncio.Queue[Hashable] = asyncio.Queue()
+        self._slots = asyncio.Semaphore(max_pending)
+        self._pending = 0
+        self._busy = 0
+        self._tasks: list[asyncio.Task] = []
+
+    @staticmethod
+    def key(message: Message) -> Hashable:
+        chat = message.chat
+        return getattr(chat, "platform", None), chat.id if chat else None
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def submit(self, message: Message):
+        """
+        Ставит сообщение в очередь его чата. Ждёт, если очередь заполнена.
+        """
+        self.start()
+        await self._slots.acquire()
+        self._pending += 1
+
+        key = self.key(message)
+        queue = self._queues.get(key)
+        if queue is None:
+            # Чат не обрабатывается и не ждёт в очереди - ставим его в конец
+            self._queues[key] = deque([message])
+            self._ready.put_nowait(key)
+        else:
+            queue.append(message)
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            queue = self._queues[key]
+            message = queue.popleft()
+            self._busy += 1
+            try:
+                await self.handler(message)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logging.error("Ошибка в обработчике сообщения: %s", e)
+            finally:
+                self._busy -= 1
+                self._pending -= 1
+                self._slots.release()
+                if queue:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._queues[key]
+                self._ready.task_done()
+
+    def depth(self, key: Optional[Hashable] = None) -> int:
+        """
+        Количество ожидающих сообщений: всего или для одного чата.
+        """
+        if key is None:
+            return self._pending
+        queue = self._queues.get(key)
+        return len(queue) if queue else 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "workers": self.workers,
+            "busy": self._busy,
+            "pending": self._pending,
+            "chats": len(self._queues),
+            "max_chat_depth": max((len(q) for q in self._queues.values()), default=0),
+            "processed": self.processed,
+            "failed": self.failed,
+        }
+
+    async def join(self):
+        """
+        Ждёт обработки всех поставленных сообщений.
+        """
+        await self._ready.join()
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
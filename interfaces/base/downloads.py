@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import os
+from typing import Callable, Iterable, Optional
+
+from .types import Media, CHUNK_SIZE
+
+GLOBAL_LIMIT = 8
+INTERFACE_LIMIT = 4
+
+Progress = Callable[[Media, int, Optional[int]], None]
+
+
+class DownloadCancelled(Exception):
+    pass
+
+
+class DownloadManager:
+    def __init__(self, limit: int = GLOBAL_LIMIT, interface_limit: int = INTERFACE_LIMIT):
+        """
+        Параллельные загрузки медиа с общими ограничениями.
+        :param limit: Максимум одновременных загрузок всего
+        :param interface_limit: Максимум одновременных загрузок на один интерфейс
+        """
+        self.limit = limit
+        self.interface_limit = interface_limit
+        self._global = asyncio.Semaphore(limit)
+        self._interfaces: dict[int, asyncio.Semaphore] = {}
+        self._tasks: dict[str, asyncio.Task] = {}
+        # Сколько вызовов download ждут загрузку в этот путь
+        self._waiters: dict[str, int] = {}
+
+    def _interface_semaphore(self, media: Media) -> asyncio.Semaphore:
+        key = id(media.caller)
+        semaphore = self._interfaces.get(key)
+        if semaphore is None:
+            semaphore = self._interfaces[key] = asyncio.Semaphore(self.interface_limit)
+        return semaphore
+
+    async def download(self, media: Media, path: str, progress: Progress = None,
+                       chunk_size: int = CHUNK_SIZE) -> str:
+        """
+        Скачивает файл в path. Данные пишутся в path + ".part", после обрыва загрузка продолжается с места остановки.
+        :param media: Файл
+        :param path: Куда сохранить
+        :param progress: Вызывается после каждой части: progress(media, получено байт, размер или None)
+        :param chunk_size: Размер части в байтах, докачка продолжается со смещения, кратного ему
+        """
+        task = self._tasks.get(path)
+        if task is None:
+            # Одновременные загрузки в один путь объединяются
+            task = asyncio.create_task(self._download(media, path, progress, chunk_size))
+            self._tasks[path] = task
+            task.add_done_callback(lambda _: self._tasks.pop(path, None))
+        self._waiters[path] = self._waiters.get(path, 0) + 1
+        try:
+            await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # Отменена сама загрузка через cancel(), а не ожидающий её код
+            if task.cancelled() and not asyncio.current_task().cancelling():
+                raise DownloadCancelled(path)
+            raise
+        finally:
+            self._waiters[path] -= 1
+            if not self._waiters[path]:
+                del self._waiters[path]
+                # Загрузка больше никому не нужна - не пишем файл дальше
+                if not task.done():
+                    task.cancel()
+        return path
+
+    async def _download(self, media: Media, path: str, progress: Optional[Progress], chunk_size: int):
+        async with self._global, self._interface_semaphore(media):
+            await self._write(media, path, progress, chunk_size)
+
+    async def _write(self, media: Media, path: str, progress: Optional[Progress], chunk_size: int):
+        loop = asyncio.get_running_loop()
+        part_path = path + ".part"
+        offset = await loop.run_in_executor(None, _prepare_part, part_path, chunk_size)
+        if offset:
+            logging.info("Продолжаем загрузку %s с %s байт", path, offset)
+
+        received = offset
+        file = await loop.run_in_executor(None, open, part_path, "ab")
+        try:
+            async for chunk in media.iter_chunks(chunk_size, offset=offset):
+                await loop.run_in_executor(None, file.write, chunk)
+                received += len(chunk)
+                if progress:
+                    progress(media, received, media.file_size)
+        finally:
+            await loop.run_in_executor(None, file.close)
+        await loop.run_in_executor(None, os.replace, part_path, path)
+
+    async def download_many(self, items: Iterable[tuple[Media, str]], progress: Progress = None) -> list:
+        """
+        Скачивает несколько файлов одновременно. При отмене отменяются все загрузки пакета.
+        :param items: Пары (файл, путь)
+        :param progress: См. download
+        :return: Пути или исключения для каждого файла в том же порядке
+        """
+        items = list(items)
+        tasks = [asyncio.create_task(self.download(media, path, progress)) for media, path in items]
+        try:
+            return await asyncio.gather(*tasks, return_exceptions=True)
+        except asyncio.CancelledError:
+            self.cancel(path for _, path in items)
+            raise
+
+    def cancel(self, paths: Iterable[str] = None):
+        """
+        Отменяет текущие загрузки. Недокачанные .part файлы остаются для докачки.
+        :param paths: Какие загрузки отменить, по умолчанию все
+        """
+        tasks = self._tasks.values() if paths is None else filter(None, map(self._tasks.get, paths))
+        for task in list(tasks):
+            task.cancel()
+
+    @property
+    def active(self) -> int:
+        return len(self._tasks)
+
+
+def _prepare_part(path: str, chunk_size: int) -> int:
+    # Докачка начинается с границы части: Telegram (upload.getFile) не принимает запросы,
+    # пересекающие границу 1 МБ, поэтому смещение должно быть кратно размеру запроса
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return 0
+    offset = size - size % chunk_size
+    if offset != size:
+        os.truncate(path, offset)
+    return offset
@@ -1,89 +1,127 @@
+import asyncio
 import logging
 import os
 from abc import ABC, abstractmethod
-from typing import Any
-
-import clipboard
+from typing import Any, AsyncIterable, Iterable, Optional
 
+from .broadcast import BroadcastReport, broadcast, BROADCAST_CONCURRENCY
+from .cache import TTLCache
+from .commands import CommandRegistry, command
+from .dispatcher import Dispatcher
+from .downloads import DownloadManager, Progress
+from .media_store import MediaStore
+from .sender import SendScheduler, Priority, GLOBAL_RATE, CHAT_RATE
+from .sharding import RemoteMedia
+from .state import StateStore
+from .tracing import tracer
 from .types import *
 
+ENTITY_CACHE_SIZE = 4096
+ENTITY_CACHE_TTL = 600.0
+
+WAIT_DOWNLOAD = "wait_download"
+HISTORY_LIMIT = 10
+MAX_HISTORY_LIMIT = 100
+
 
 class BaseInterface:
-    def __init__(self, user_db: Any):
+    def __init__(self, user_db: Any, states: StateStore = None):
+        """
+        :param user_db: Хранилище истории (Storage) или None
+        :param states: Состояния диалогов, по умолчанию только в памяти
+        """
         self.user_db = user_db
-        self.await_download_users = []
+        self.states = states if states is not None else StateStore()
+        self.dispatcher = Dispatcher(self.message_handler)
+        self.media_store = MediaStore()
+        self.downloads = DownloadManager()
+        self.commands = CommandRegistry.from_object(self)
+
+    async def dispatch(self, message: Message):
+        """
+        Передаёт сообщение в очередь обработки. Интерфейсы вызывают его вместо message_handler.
+        """
+        if self.user_db is not None:
+            # Только постановка в очередь записи, диск - в отдельном потоке
+            self.user_db.store_message(message)
+        await self.dispatcher.submit(message)
 
     async def message_handler(self, message: Message):
-        try:
-            if message.attachments and message.from_user.id in self.await_download_users:
-                message.text = "/download"
-
-            if message.from_user.id == 1667209703:
-                replace = {
-                    ", platform='Telegram'": "",
-                    "TelegramUser(id=1667209703, first_name='онигири', last_name=None, username='Y_kto_to', is_bot=False)": "user",
-                    "TelegramChat(id=1667209703, type=<ChatType.PRIVATE: 'private'>, title='онигири', members=[user])": "chat",
-                }
-                f = str(message)
-                for key, value in replace.items():
-                    f = f.replace(key, value)
-                f = f + ","
-                clipboard.copy(f)
-
-            print(message)
-            print("Source:", message.source)
-            if message.attachments:
-                print(message.attachments[0])
-            print(f"{message.from_user.first_name}: {message.text!r}")
-
-            if message.text.startswith("/"):
-                await self.command_handler(message)
-        except Exception as e:
-            logging.error(f"Ошибка при обработке сообщения: {e}")
-            await message.answer("Произошла ошибка при обработке вашего сообщения.")
+        with tracer.span("handler"):
+            try:
+                if message.attachments and self.states.get(StateStore.key(message)) == WAIT_DOWNLOAD:
+                    self.states.pop(StateStore.key(message))
+                    message.text = "/download"
+
+                logging.debug("Сообщение: %s", message)
+
+                if message.text.startswith("/"):
+                    await self.command_handler(message)
+            except Exception as e:
+                logging.error("Ошибка при обработке сообщения: %s", e)
+                await message.answer("Произошла ошибка при обработке вашего сообщения.")
 
     async def command_handler(self, message: Message):
         try:
             raw = message.text[1:].split(" ")
-            command = raw[0]
+            name = raw[0]
             args = raw[1:]
-            func = getattr(self, command, None)
-            if func:
-                num_args_expected = func.__code__.co_argcount - 2  # Вычитаем 1, так как первый аргумент это self
-                num_args_provided = len(args)
-                if num_args_provided < num_args_expected:
-                    raise ValueError(
-                        f"Недостаточно аргументов. Ожидалось как минимум: {num_args_expected}, получено: {num_args_provided}")
-                result = await func(message, *args)
+            cmd = self.commands.find(name)
+            if cmd:
+                with tracer.span("command", cmd.name):
+                    result = await cmd(message, args)
                 if result:
                     await message.reply(result)
             else:
-                logging.warning(f"Неизвестная команда: {command}")
-                await message.answer(f"Неизвестная команда: {command}")
+                logging.warning("Неизвестная команда: %s", name)
+                await message.answer(f"Неизвестная команда: {name}")
         except ValueError as e:
-            logging.error(f"{e}")
+            logging.error("%s", e)
             await message.answer(f"{e}")
         except Exception as e:
-            logging.error(f"Ошибка при обработке команды: {e}")
+            logging.error("Ошибка при обработке команды: %s", e)
             await message.answer("Произошла ошибка при обработке вашей команды.")
 
-    async def _download(self, attachment: Media):
-        if hasattr(attachment, "get"):
-            b = await attachment.get()
+    async def _download(self, attachment: Media, progress: Progress = None):
+        if isinstance(attachment, RemoteMedia):
+            # В процессе-воркере: скачивает и хранит файлы I/O процесс
+            await attachment.download()
+            return
+        if hasattr(attachment, "save_to"):
             if attachment.file_name:
                 file_name = attachment.file_name
             else:
                 file_name = "unknown"
-                logging.warning(f"Неизвестный тип сущности: {type(attachment)}")
-            with open(file_name, "wb") as f:
-                f.write(b)
+                logging.warning("Неизвестный тип сущности: %s", type(attachment))
 
+            key = self.media_store.key(attachment)
+            if key is None:
+                await self.downloads.download(attachment, file_name, progress)
+                return
+
+            # Повторные файлы берутся из хранилища без сети и без лишней копии на диске
+            await self.media_store.ensure(key, lambda path: self.downloads.download(attachment, path, progress))
+            await self.media_store.link(key, file_name)
+
+    @command(aliases=("?",))
+    async def help(self, message: Message):
+        """Список команд"""
+        return self.commands.help()
+
+    @command()
+    async def stats(self, message: Message):
+        """Время этапов обработки сообщений"""
+        return tracer.summary()
+
+    @command()
     async def echo(self, message: Message, *args):
         return message.text
 
+    @command()
     async def system(self, message: Message, *args):
         return f"Exit code: {str(os.system(" ".join(args)))}"
 
+    @command()
     async def exec(self, message: Message, *args):
         code = " ".join(args)
         local_vars = locals()
@@ -92,33 +130,165 @@ class BaseInterface:
             await local_vars["__exec"]()
             return "Код выполнен успешно."
         except Exception as e:
-            logging.error(f"Ошибка при выполнении кода: {e}")
+            logging.error("Ошибка при выполнении кода: %s", e)
             return f"Ошибка при выполнении кода: {e}"
 
+    @command()
+    async def history(self, message: Message, limit: int = HISTORY_LIMIT):
+        """Последние сообщения этого чата из локальной истории"""
+        if self.user_db is None:
+            return "История не сохраняется."
+        # Отрицательный LIMIT в SQLite означает "без ограничения"
+        limit = max(1, min(limit, MAX_HISTORY_LIMIT))
+        rows = await self.user_db.get_messages(message.platform_name(), message.chat.id, limit=limit)
+        if not rows:
+            return "История пуста."
+        return "\n".join(f"{row['user_id']}: {row['text']}" for row in reversed(rows))
+
+    @command()
+    async def search(self, message: Message, *words):
+        """Поиск по истории этого чата"""
+        if self.user_db is None:
+            return "История не сохраняется."
+        if not words:
+            return "Использование: /search слова"
+        rows = await self.user_db.search(" ".join(words), chat=message.chat)
+        if not rows:
+            return "Ничего не найдено."
+        return "\n".join(f"{row['user_id']}: {row['snippet']}" for row in rows)
+
+    @command()
     async def download(self, message: Message, *args):
         if message.attachments:
-            for media in message.attachments:
-                if isinstance(media, Media):
-                    await self._download(media)
+            media_list = [media for media in await message.get_attachments() if isinstance(media, Media)]
+            # Загрузки идут параллельно, ограничения - в DownloadManager
+            tasks = [asyncio.create_task(self._download(media)) for media in media_list]
+            try:
+                await asyncio.gather(*tasks)
+            except Exception as e:
+                # Ответ уже будет с ошибкой - остальные загрузки не должны продолжать писать файлы
+                logging.error("Ошибка при загрузке: %s", e)
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                done = sum(not task.cancelled() and task.exception() is None for task in tasks)
+                return f"Скачано {done} из {len(media_list)}."
             return "Скачано!"
         else:
-            self.await_download_users.append(message.from_user.id)
-            print(self.await_download_users)  # TODO: использовать logging
+            self.states.set(StateStore.key(message), WAIT_DOWNLOAD)
             return "Ожидаю медиа..."
 
 
 class Interface(ABC):
-    def __init__(self, base_interface: BaseInterface):
+    platform: str = None
+    # Лимиты отправки платформы, сообщений в секунду
+    send_rate: float = GLOBAL_RATE
+    chat_send_rate: float = CHAT_RATE
+
+    def __init__(self, base_interface: BaseInterface, lazy_attachments: bool = True, keep_source: bool = True):
         self.base_interface = base_interface
+        # Вложения преобразуются только когда обработчик их запросит (Message.get_attachments)
+        self.lazy_attachments = lazy_attachments
+        # Хранить ли в сущностях исходные объекты платформы. Медиа хранят их всегда - без них не скачать файл
+        self.keep_source = keep_source
+        # Общий кэш сущностей платформы (пользователи, чаты), чтобы не ходить в API на каждое сообщение
+        self.entity_cache = TTLCache(maxsize=ENTITY_CACHE_SIZE, ttl=ENTITY_CACHE_TTL)
+        # Все исходящие сообщения идут через очередь с ограничением частоты
+        self.sender = SendScheduler(self.send_rate, self.chat_send_rate, retry_after=self.retry_after,
+                                    chat_limited=self.chat_limited)
+
+    def retry_after(self, error: Exception) -> Optional[float]:
+        """
+        Если ошибка - превышение лимита платформы, возвращает сколько секунд подождать, иначе None.
+        """
+        return None
+
+    def chat_limited(self, error: Exception) -> bool:
+        """
+        Относится ли превышение лимита из retry_after только к одному чату. По умолчанию - ко всему аккаунту.
+        """
+        return False
+
+    @abstractmethod
+    async def transform(self, obj: Any) -> Entity:
+        pass
+
+    async def transform_many(self, objects: Iterable[Any]) -> list[Entity]:
+        """
+        Преобразует сразу несколько объектов платформы. Интерфейсы переопределяют его,
+        чтобы получать связанных пользователей и чаты одним запросом.
+        """
+        return [await self.transform(obj) for obj in objects]
 
     @abstractmethod
     async def get_entity(self, id: int) -> Entity:
         pass
 
+    @abstractmethod
+    async def get_messages(self, chat: int, limit: int = 100, offset: int = 0) -> list[Message]:
+        """
+        История чата, от новых сообщений к старым.
+        :param chat: ID чата
+        :param limit: Сколько сообщений получить
+        :param offset: Сколько последних сообщений пропустить
+        """
+        pass
+
     @abstractmethod
     async def send_message(self, id: int, text: str, entities: list[Media] = None) -> Message:
         pass
 
+    async def send(self, id: int, text: str, attachments: list[Media] = None) -> Any:
+        """
+        Отправка без преобразования ответа платформы в Message - для рассылок, где результат не нужен.
+        Интерфейсы переопределяют его, по умолчанию вызывается send_message.
+        :return: Ответ платформы как есть
+        """
+        return await self.send_message(id, text, attachments)
+
+    async def prepare_attachments(self, attachments: list[Media]) -> list[Media]:
+        """
+        Готовит вложения к многократной отправке (например, загружает файлы на сервер платформы один раз).
+        По умолчанию вложения отправляются как есть.
+        """
+        return attachments
+
+    async def broadcast(self, ids: Iterable[int] | AsyncIterable[int], text: str, attachments: list[Media] = None,
+                        concurrency: int = BROADCAST_CONCURRENCY, checkpoint: str = None) -> BroadcastReport:
+        """
+        Рассылка сообщения многим получателям с ограниченной параллельностью.
+        Отправки идут через sender в очереди BROADCAST, то есть после ответов и с соблюдением лимитов.
+        :param ids: Получатели, обычный или асинхронный итератор - список целиком не нужен
+        :param text: Текст сообщения
+        :param attachments: Вложения, загружаются один раз на всю рассылку
+        :param concurrency: Сколько отправок выполняется одновременно
+        :param checkpoint: Файл прогресса, чтобы продолжить прерванную рассылку с того же места
+        :return: Отчёт по каждому получателю
+        """
+        prepared = await self.prepare_attachments(attachments) if attachments else None
+        with self.sender.priority(Priority.BROADCAST):
+            return await broadcast(lambda id: self.send(id, text, prepared), ids,
+                                   concurrency=concurrency, checkpoint=checkpoint)
+
+    async def connect(self):
+        """
+        Подключение и авторизация на платформе. Вызывается до start, для всех интерфейсов одновременно.
+        """
+        pass
+
     @abstractmethod
     async def start(self):
         pass
+
+    async def pause(self):
+        """
+        Прекращение приёма новых сообщений при остановке. Отправка продолжает работать,
+        пока обрабатываются уже принятые сообщения.
+        """
+        pass
+
+    async def stop(self):
+        """
+        Отключение от платформы при остановке. Вызывается после обработки уже принятых сообщений.
+        """
+        await self.sender.close()
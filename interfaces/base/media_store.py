@@ -0,0 +1,320 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import shutil
+import uuid
+from collections import OrderedDict
+from typing import Awaitable, Callable, Hashable, Optional
+
+from .types import Media
+
+MEDIA_DIRECTORY = "media_cache"
+MAX_BYTES = 2 * 1024 ** 3
+HOT_BYTES = 64 * 1024 ** 2
+HOT_ITEM_BYTES = 4 * 1024 ** 2
+INDEX_FILE = "index.json"
+# Новые ключи за это время записываются в индекс одним сохранением
+INDEX_SAVE_DELAY = 1.0
+
+
+class MediaStore:
+    def __init__(self, directory: str = MEDIA_DIRECTORY, max_bytes: int = MAX_BYTES, hot_bytes: int = HOT_BYTES,
+                 save_delay: float = INDEX_SAVE_DELAY):
+        """
+        Локальное хранилище медиа с адресацией по содержимому.
+        Файл хранится один раз под своим sha256, ключи платформы (платформа, ID файла) ссылаются на хэш.
+        Папка создаётся при первой записи.
+        :param directory: Папка хранилища
+        :param max_bytes: Максимальный размер хранилища на диске, при превышении удаляются давно не использованные
+        :param hot_bytes: Размер кэша небольших файлов в памяти
+        :param save_delay: Через сколько секунд после изменения сохранять индекс
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hot_bytes = hot_bytes
+        self.save_delay = save_delay
+        self.hits = 0
+        self.misses = 0
+        self._blobs_directory = os.path.join(directory, "blobs")
+        self._index: dict[str, str] = {}
+        # Обратный индекс: sha256 -> ключи, чтобы при удалении файла не перебирать весь индекс
+        self._keys: dict[str, set[Hashable]] = {}
+        self._blobs: OrderedDict[str, int] = OrderedDict()
+        self._hot: OrderedDict[str, bytes] = OrderedDict()
+        self._hot_size = 0
+        self._size = 0
+        # Ключи, которые сейчас скачиваются в хранилище
+        self._pending: dict[Hashable, asyncio.Future] = {}
+        self._waiters: dict[Hashable, int] = {}
+        self._created = False
+        self._save_handle: Optional[asyncio.TimerHandle] = None
+        self._saving: Optional[asyncio.Future] = None
+        self._load()
+
+    def _load(self):
+        if not os.path.isdir(self._blobs_directory):
+            return
+        self._created = True
+        entries = []
+        for name in os.listdir(self._blobs_directory):
+            stat = os.stat(os.path.join(self._blobs_directory, name))
+            entries.append((stat.st_atime, name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._blobs[name] = size
+            self._size += size
+
+        try:
+            with open(os.path.join(self.directory, INDEX_FILE), encoding="utf-8") as f:
+                self._index = {key: digest for key, digest in json.load(f).items() if digest in self._blobs}
+        except (OSError, ValueError):
+            self._index = {}
+        for key, digest in self._index.items():
+            self._keys.setdefault(digest, set()).add(key)
+
+    def _create_directory(self):
+        if not self._created:
+            os.makedirs(self._blobs_directory, exist_ok=True)
+            self._created = True
+
+    @staticmethod
+    def key(media: Media) -> Optional[str]:
+        """
+        Ключ файла на платформе, None если у файла нет постоянного ID.
+        """
+        platform = getattr(media.caller, "platform", None)
+        if not media.id or not platform:
+            return None
+        return f"{platform}:{media.id}"
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self._blobs_directory, digest)
+
+    def path(self, key: Hashable) -> Optional[str]:
+        digest = self._index.get(key)
+        if digest is None:
+            return None
+        self._blobs.move_to_end(digest)
+        return self._blob_path(digest)
+
+    def __contains__(self, key: Hashable):
+        return key in self._index
+
+    async def get_bytes(self, key: Hashable) -> Optional[bytes]:
+        digest = self._index.get(key)
+        if digest is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._blobs.move_to_end(digest)
+        data = self._hot.get(digest)
+        if data is not None:
+            self._hot.move_to_end(digest)
+            return data
+
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(None, _read, self._blob_path(digest))
+        self._remember(digest, data)
+        return data
+
+    async def put_bytes(self, key: Hashable, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        if digest not in self._blobs:
+            self._create_directory()
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, _write, self._blob_path(digest), data)
+            self._add_blob(digest, len(data))
+        self._remember(digest, data)
+        self._bind(key, digest)
+        return digest
+
+    def temp_path(self, key: Hashable = None) -> str:
+        """
+        Путь для загрузки файла в хранилище. Для одного ключа путь всегда одинаковый, чтобы загрузку можно было докачать.
+        """
+        self._create_directory()
+        name = hashlib.sha1(str(key).encode()).hexdigest() if key is not None else uuid.uuid4().hex
+        return os.path.join(self.directory, f"{name}.download")
+
+    async def put_file(self, key: Hashable, path: str) -> str:
+        """
+        Переносит скачанный файл в хранилище. Если такое содержимое уже есть, файл удаляется.
+        :param key: Ключ файла на платформе
+        :param path: Путь к файлу, лучше полученный через temp_path() - тогда перенос без копирования
+        """
+        loop = asyncio.get_running_loop()
+        digest, size = await loop.run_in_executor(None, _hash_file, path)
+        if digest in self._blobs:
+            await loop.run_in_executor(None, os.remove, path)
+        else:
+            await loop.run_in_executor(None, shutil.move, path, self._blob_path(digest))
+            self._add_blob(digest, size)
+        self._bind(key, digest)
+        return digest
+
+    async def ensure(self, key: Hashable, download: Callable[[str], Awaitable]) -> str:
+        """
+        Скачивает файл в хранилище, если его там ещё нет. Одновременные вызовы для одного ключа ждут одну загрузку.
+        :param key: Ключ файла на платформе
+        :param download: Функция, скачивающая файл по переданному пути (temp_path)
+        :return: sha256 содержимого
+        """
+        digest = self._index.get(key)
+        if digest is not None:
+            return digest
+        task = self._pending.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._download(key, download))
+            self._pending[key] = task
+            task.add_done_callback(lambda _: self._pending.pop(key, None))
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+                # Все ожидающие отменены - отменяем и загрузку
+                if not task.done():
+                    task.cancel()
+
+    async def _download(self, key: Hashable, download: Callable[[str], Awaitable]) -> str:
+        path = self.temp_path(key)
+        await download(path)
+        return await self.put_file(key, path)
+
+    async def link(self, key: Hashable, destination: str) -> bool:
+        """
+        Создаёт файл destination из хранилища жёсткой ссылкой (без копирования данных), если не выходит - копией.
+        :return: Был ли файл в хранилище
+        """
+        source = self.path(key)
+        if source is None:
+            return False
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, _link, source, destination)
+        return True
+
+    def _remember(self, digest: str, data: bytes):
+        if len(data) > HOT_ITEM_BYTES or digest in self._hot:
+            return
+        self._hot[digest] = data
+        self._hot_size += len(data)
+        while self._hot_size > self.hot_bytes:
+            _, evicted = self._hot.popitem(last=False)
+            self._hot_size -= len(evicted)
+
+    def _add_blob(self, digest: str, size: int):
+        self._blobs[digest] = size
+        self._size += size
+        while self._size > self.max_bytes and len(self._blobs) > 1:
+            evicted, evicted_size = self._blobs.popitem(last=False)
+            self._size -= evicted_size
+            data = self._hot.pop(evicted, None)
+            if data is not None:
+                self._hot_size -= len(data)
+            for key in self._keys.pop(evicted, ()):
+                del self._index[key]
+            self._schedule_save()
+            try:
+                os.remove(self._blob_path(evicted))
+            except OSError as e:
+                logging.warning("Не удалось удалить файл из хранилища медиа: %s", e)
+
+    def _bind(self, key: Hashable, digest: str):
+        if key is None:
+            return
+        previous = self._index.get(key)
+        if previous == digest:
+            return
+        if previous is not None:
+            self._keys[previous].discard(key)
+        self._index[key] = digest
+        self._keys.setdefault(digest, set()).add(key)
+        self._schedule_save()
+
+    def _schedule_save(self):
+        if self._save_handle is not None:
+            return
+        self._save_handle = asyncio.get_running_loop().call_later(self.save_delay, self._save_later)
+
+    def _save_later(self):
+        loop = asyncio.get_running_loop()
+        if self._saving is not None and not self._saving.done():
+            # Предыдущая запись ещё идёт - сохраним после неё
+            self._save_handle = loop.call_later(self.save_delay, self._save_later)
+            return
+        self._save_handle = None
+        self._saving = loop.run_in_executor(None, _write_index, os.path.join(self.directory, INDEX_FILE),
+                                            dict(self._index))
+        self._saving.add_done_callback(_log_error)
+
+    async def close(self):
+        """
+        Сохраняет индекс сразу, не дожидаясь отложенного сохранения. Вызывается при остановке.
+        """
+        pending = self._save_handle is not None
+        if pending:
+            self._save_handle.cancel()
+            self._save_handle = None
+        if self._saving is not None:
+            # Иначе запись старого снимка может закончиться позже и перезаписать файл
+            await asyncio.wait([self._saving])
+            self._saving = None
+        if pending:
+            await asyncio.to_thread(_write_index, os.path.join(self.directory, INDEX_FILE), dict(self._index))
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "keys": len(self._index),
+            "blobs": len(self._blobs),
+            "bytes": self._size,
+            "hot_bytes": self._hot_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def _log_error(future: asyncio.Future):
+    if not future.cancelled() and future.exception() is not None:
+        logging.error("Не удалось сохранить индекс хранилища медиа: %s", future.exception())
+
+
+def _read(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _write(path: str, data: bytes):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def _write_index(path: str, index: dict[str, str]):
+    temp = path + ".tmp"
+    with open(temp, "w", encoding="utf-8") as f:
+        json.dump(index, f)
+    os.replace(temp, path)
+
+
+def _hash_file(path: str) -> tuple[str, int]:
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+
+def _link(source: str, destination: str):
+    if os.path.exists(destination):
+        if os.path.samefile(source, destination):
+            return
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
@@ -0,0 +1,64 @@
+from collections import Counter
+from typing import Any, Callable, Optional
+
+_MISSING = object()
+
+
+class ConversionRegistry:
+    def __init__(self, name: str):
+        """
+        Таблица "тип объекта платформы -> конвертер".
+        Поиск по точному типу - один словарь; для подклассов ищется ближайший предок по MRO,
+        результат (в том числе промах) запоминается для этого типа.
+        :param name: Название таблицы для метрик
+        """
+        self.name = name
+        self.unknown: Counter[str] = Counter()
+        self._converters: dict[type, Any] = {}
+        self._resolved: dict[type, Any] = {}
+
+    def add(self, type_: type, value: Any):
+        self._converters[type_] = value
+        # Добавленный тип может изменить результат MRO-поиска для уже встреченных подклассов
+        self._resolved.clear()
+
+    def register(self, *types_: type) -> Callable:
+        """
+        Декоратор: регистрирует функцию как конвертер для перечисленных типов.
+        """
+
+        def decorator(value):
+            for type_ in types_:
+                self.add(type_, value)
+            return value
+
+        return decorator
+
+    def get(self, type_: type) -> Any:
+        value = self._resolved.get(type_, _MISSING)
+        if value is _MISSING:
+            value = None
+            for klass in type_.__mro__:
+                if klass in self._converters:
+                    value = self._converters[klass]
+                    break
+            self._resolved[type_] = value
+        return value
+
+    def lookup(self, obj: object) -> Optional[Any]:
+        """
+        Конвертер для объекта. Если его нет, тип учитывается в unknown.
+        """
+        value = self.get(type(obj))
+        if value is None:
+            self.unknown[type(obj).__name__] += 1
+        return value
+
+    def __contains__(self, type_: type):
+        return self.get(type_) is not None
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "registered": len(self._converters),
+            "unknown": dict(self.unknown),
+        }
@@ -0,0 +1,262 @@
+import asyncio
+import bisect
+import contextlib
+import contextvars
+import enum
+import itertools
+import logging
+import time
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+from .tracing import tracer
+
+GLOBAL_RATE = 30.0
+CHAT_RATE = 1.0
+CHAT_BURST = 3
+MAX_RETRIES = 3
+MAX_BUCKETS = 10000
+
+
+class Priority(enum.IntEnum):
+    """
+    Очереди отправки, меньшее значение отправляется раньше.
+    """
+    REPLY = 0
+    MESSAGE = 1
+    BROADCAST = 2
+
+
+# Очередь по умолчанию для отправок из текущей задачи, см. SendScheduler.priority
+_current_priority: contextvars.ContextVar[int] = contextvars.ContextVar("send_priority", default=Priority.MESSAGE)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        """
+        Ограничитель частоты "ведро с токенами".
+        :param rate: Токенов в секунду
+        :param capacity: Размер ведра, то есть допустимый всплеск
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """
+        Сколько секунд ждать до следующего токена, 0 - можно отправлять.
+        """
+        now = time.monotonic()
+        if self.paused_until > now:
+            return self.paused_until - now
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self._refill(time.monotonic())
+        self.tokens -= 1
+
+    def full(self) -> bool:
+        """
+        Ведро восстановилось полностью и не на паузе - ничем не отличается от нового.
+        """
+        now = time.monotonic()
+        if self.paused_until > now:
+            return False
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class _Job:
+    __slots__ = ("priority", "seq", "chat", "send", "future", "coalesce_key", "attempts")
+
+    def __init__(self, priority: int, seq: int, chat: Hashable, send: Callable[[], Awaitable],
+                 future: asyncio.Future, coalesce_key: Optional[Hashable]):
+        self.priority = priority
+        self.seq = seq
+        self.chat = chat
+        self.send = send
+        self.future = future
+        self.coalesce_key = coalesce_key
+        self.attempts = 0
+
+    def __lt__(self, other: "_Job"):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class SendScheduler:
+    def __init__(self, global_rate: float = GLOBAL_RATE, chat_rate: float = CHAT_RATE, chat_burst: int = CHAT_BURST,
+                 retry_after: Callable[[Exception], Optional[float]] = None, max_retries: int = MAX_RETRIES,
+                 chat_limited: Callable[[Exception], bool] = None):
+        """
+        Очередь исходящих сообщений с ограничением частоты на чат и в целом.
+        Сообщения одного чата уходят по порядку, ответы - раньше рассылок.
+        :param global_rate: Сообщений в секунду всего
+        :param chat_rate: Сообщений в секунду в один чат
+        :param chat_burst: Сколько сообщений в чат можно отправить подряд без ожидания
+        :param retry_after: Возвращает, сколько секунд ждать, если ошибка - превышение лимита платформы, иначе None
+        :param max_retries: Сколько раз повторять отправку после превышения лимита
+        :param chat_limited: True, если превышен лимит только этого чата (медленный режим) - тогда ждёт только он.
+        По умолчанию лимит считается общим для аккаунта и останавливает все отправки
+        """
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.retry_after = retry_after or (lambda e: None)
+        self.max_retries = max_retries
+        self.chat_limited = chat_limited or (lambda e: False)
+        self.sent = 0
+        self.coalesced = 0
+        self.retried = 0
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: dict[Hashable, TokenBucket] = {}
+        self._jobs: list[_Job] = []
+        self._coalescing: dict[Hashable, _Job] = {}
+        self._in_flight: set[Hashable] = set()
+        self._sending: set[asyncio.Task] = set()
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def _bucket(self, chat: Hashable) -> TokenBucket:
+        bucket = self._chats.get(chat)
+        if bucket is None:
+            if len(self._chats) >= MAX_BUCKETS:
+                # Полное ведро ничем не отличается от нового, его можно забыть
+                self._chats = {key: value for key, value in self._chats.items()
+                               if not value.full() or key in self._in_flight}
+            bucket = self._chats[chat] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    @staticmethod
+    @contextlib.contextmanager
+    def priority(priority: int):
+        """
+        Задаёт очередь по умолчанию для всех отправок внутри блока, включая созданные в нём задачи.
+        """
+        token = _current_priority.set(priority)
+        try:
+            yield
+        finally:
+            _current_priority.reset(token)
+
+    async def submit(self, chat: Hashable, send: Callable[[], Awaitable], priority: int = None,
+                     coalesce_key: Hashable = None) -> Any:
+        """
+        Ставит отправку в очередь и ждёт её результата.
+        :param chat: ID чата получателя
+        :param send: Функция без аргументов, возвращающая корутину отправки
+        :param priority: Очередь, см. Priority. По умолчанию - заданная через SendScheduler.priority или MESSAGE
+        :param coalesce_key: Если в очереди уже ждёт отправка с тем же ключом (например, правка того же сообщения),
+        она заменяется новой, и оба вызова получают один результат
+        """
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+        if coalesce_key is not None:
+            job = self._coalescing.get(coalesce_key)
+            if job is not None:
+                job.send = send
+                self.coalesced += 1
+                return await asyncio.shield(job.future)
+
+        if priority is None:
+            priority = _current_priority.get()
+        job = _Job(priority, next(self._seq), chat, send, asyncio.get_running_loop().create_future(), coalesce_key)
+        if coalesce_key is not None:
+            self._coalescing[coalesce_key] = job
+        self._push(job)
+        return await asyncio.shield(job.future)
+
+    def _push(self, job: _Job):
+        bisect.insort(self._jobs, job)
+        self._wakeup.set()
+
+    def _next_job(self) -> tuple[Optional[_Job], float]:
+        """
+        Первая по приоритету отправка, которую можно выполнить сейчас, или время ожидания.
+        """
+        wait = self._global.delay()
+        if wait:
+            return None, wait
+
+        wait = None
+        for index, job in enumerate(self._jobs):
+            if job.chat in self._in_flight:
+                continue
+            delay = self._bucket(job.chat).delay()
+            if not delay:
+                return self._jobs.pop(index), 0.0
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    async def _run(self):
+        while True:
+            job, wait = self._next_job()
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            if job.coalesce_key is not None:
+                self._coalescing.pop(job.coalesce_key, None)
+            self._global.consume()
+            self._bucket(job.chat).consume()
+            self._in_flight.add(job.chat)
+            task = asyncio.create_task(self._send(job))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, job: _Job):
+        try:
+            with tracer.span("send"):
+                result = await job.send()
+        except Exception as e:
+            seconds = self.retry_after(e)
+            if seconds is not None and job.attempts < self.max_retries:
+                job.attempts += 1
+                self.retried += 1
+                if self.chat_limited(e):
+                    logging.warning("Превышен лимит отправки в чат %s, повтор через %s с", job.chat, seconds)
+                    self._bucket(job.chat).pause(seconds)
+                else:
+                    # Лимит аккаунта: отправки в другие чаты только продлили бы ожидание
+                    logging.warning("Превышен лимит отправки, все отправки приостановлены на %s с", seconds)
+                    self._global.pause(seconds)
+                self._push(job)
+            elif not job.future.done():
+                job.future.set_exception(e)
+        else:
+            self.sent += 1
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._in_flight.discard(job.chat)
+            self._wakeup.set()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "queued": len(self._jobs),
+            "in_flight": len(self._in_flight),
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "retried": self.retried,
+        }
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
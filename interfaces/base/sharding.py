@@ -0,0 +1,484 @@
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import pickle
+import threading
+import time
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+from .cache import TTLCache
+from .dispatcher import Dispatcher, MAX_PENDING
+from .state import StateStore
+from .types import Attachment, Entity, LazyAttachment, Media, Message
+
+# Методы живого сообщения, которые воркер может вызвать через RPC
+REMOTE_METHODS = ("reply", "answer", "edit")
+# Как часто проверять, живы ли процессы-воркеры, в секундах
+WATCH_INTERVAL = 1.0
+# Сколько секунд изменённое воркером состояние считается новее копии, пришедшей с сообщением
+STATE_SYNC_TTL = 60.0
+STATE_SYNC_SIZE = 10000
+
+
+# Между процессами - pickle: Entity.__getstate__ отбрасывает source и caller, Lazy передаёт только готовое значение
+def encode(obj: Any) -> bytes:
+    return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def decode(data: bytes) -> Any:
+    return pickle.loads(data)
+
+
+def _picklable_error(error: Exception) -> Exception:
+    try:
+        pickle.dumps(error)
+        return error
+    except Exception:
+        return RuntimeError(f"{type(error).__name__}: {error}")
+
+
+class RemoteInterface:
+    def __init__(self, connection: "_WorkerConnection", platform: str):
+        """
+        Заместитель интерфейса в процессе-воркере: вызовы уходят в I/O процесс.
+        :param connection: Канал воркера
+        :param platform: Платформа исходного интерфейса
+        """
+        self.connection = connection
+        self.platform = platform
+        self.keep_source = False
+        self.lazy_attachments = True
+
+    async def call(self, token: int, method: str, *args) -> Any:
+        return await self.connection.call(token, method, args)
+
+
+class RemoteMedia(Media):
+    __slots__ = ("token", "index", "original")
+
+    def __init__(self, token: int, index: int, original: Media, caller: RemoteInterface = None):
+        """
+        Медиа из I/O процесса. Содержимое запрашивается через RPC.
+        :param token: Токен сообщения в I/O процессе
+        :param index: Номер вложения в сообщении
+        :param original: Исходное медиа без source и caller
+        """
+        super().__init__(original.id, original.file_name, original.file_size, caller=caller)
+        self.token = token
+        self.index = index
+        self.original = original
+
+    async def get(self) -> Optional[bytes]:
+        return await self.caller.call(self.token, "media_get", self.index)
+
+    async def download(self):
+        """
+        Сохраняет файл в хранилище медиа I/O процесса: файл идёт туда потоком, не через очередь между процессами.
+        """
+        await self.caller.call(self.token, "media_download", self.index)
+
+
+class RemoteMessage(Message):
+    __slots__ = ("token",)
+
+    def __init__(self, token: int, message: Message, caller: RemoteInterface):
+        """
+        Сообщение в процессе-воркере. Ответы и вложения идут через живое сообщение в I/O процессе.
+        :param token: Токен сообщения в I/O процессе
+        :param message: Сообщение без source и caller
+        """
+        attachments = [
+            RemoteMedia(token, index, attachment, caller) if isinstance(attachment, Media) else attachment
+            for index, attachment in enumerate(message.attachments)
+        ]
+        super().__init__(message.id, message.from_user, message.chat, message.date, message.text, attachments,
+                         caller=caller)
+        self.token = token
+
+    async def get_attachments(self) -> list[Attachment]:
+        # Отложенные вложения преобразуются в I/O процессе, там же, где их source
+        if any(isinstance(attachment, LazyAttachment) for attachment in self.attachments):
+            attachments = await self.caller.call(self.token, "get_attachments")
+            self.attachments = [
+                RemoteMedia(self.token, index, attachment, self.caller) if isinstance(attachment, Media) else attachment
+                for index, attachment in enumerate(attachments)
+            ]
+        return self.attachments
+
+    async def reply(self, text: str, attachments: list[Attachment] = None):
+        return await self.caller.call(self.token, "reply", text, attachments)
+
+    async def answer(self, text: str, attachments: list[Attachment] = None):
+        return await self.caller.call(self.token, "answer", text, attachments)
+
+    async def edit(self, text: str, attachments: list[Attachment] = None):
+        return await self.caller.call(self.token, "edit", text, attachments)
+
+
+class _WorkerConnection:
+    def __init__(self, index: int, outbox: multiprocessing.Queue):
+        self.index = index
+        self.outbox = outbox
+        self._calls = itertools.count()
+        self._waiting: dict[int, asyncio.Future] = {}
+        self._interfaces: dict[str, RemoteInterface] = {}
+
+    def interface(self, platform: str) -> RemoteInterface:
+        interface = self._interfaces.get(platform)
+        if interface is None:
+            interface = self._interfaces[platform] = RemoteInterface(self, platform)
+        return interface
+
+    async def call(self, token: int, method: str, args: tuple) -> Any:
+        call_id = next(self._calls)
+        future = self._waiting[call_id] = asyncio.get_running_loop().create_future()
+        self.outbox.put(encode(("call", self.index, call_id, token, method, args)))
+        try:
+            return await future
+        finally:
+            self._waiting.pop(call_id, None)
+
+    def resolve(self, call_id: int, ok: bool, value: Any):
+        future = self._waiting.get(call_id)
+        if future is None or future.done():
+            return
+        if ok:
+            future.set_result(value)
+        else:
+            future.set_exception(value)
+
+    def done(self, token: int):
+        self.outbox.put(encode(("done", self.index, token)))
+
+    def state(self, key: Hashable, state: Optional[str], data: Any, ttl: Optional[float]):
+        self.outbox.put(encode(("state", self.index, key, state, data, ttl)))
+
+
+class _SyncedStateStore(StateStore):
+    def __init__(self, connection: _WorkerConnection):
+        """
+        Состояния диалогов в процессе-воркере. Хранит их StateStore I/O процесса (и сохраняет в файл):
+        изменения отправляются туда, а текущее состояние приходит вместе с каждым сообщением.
+        """
+        super().__init__()
+        self.connection = connection
+        # Ключи, изменённые здесь недавно: копия из I/O процесса для них может ещё не включать изменение
+        self._changed = TTLCache(maxsize=STATE_SYNC_SIZE, ttl=STATE_SYNC_TTL)
+
+    def set(self, key: Hashable, state: str, data: Any = None, ttl: float = None):
+        super().set(key, state, data, ttl)
+        self._changed.set(key, True)
+        self.connection.state(key, state, data, self.ttl if ttl is None else ttl)
+
+    def pop(self, key: Hashable) -> Optional[str]:
+        state = super().pop(key)
+        self._changed.set(key, True)
+        self.connection.state(key, None, None, None)
+        return state
+
+    def restore(self, key: Hashable, item: Optional[tuple[str, Any, float]]):
+        """
+        Принимает состояние из I/O процесса, если здесь оно не менялось недавно.
+        """
+        if key in self._changed:
+            return
+        if item is None:
+            super().pop(key)
+        else:
+            state, data, expires = item
+            super().set(key, state, data, expires - time.time())
+
+
+def _read(queue: multiprocessing.Queue, loop: asyncio.AbstractEventLoop, callback: Callable[[Any], None]):
+    """
+    Читает очередь в отдельном потоке и передаёт сообщения в цикл событий. None - конец.
+    """
+    while True:
+        data = queue.get()
+        loop.call_soon_threadsafe(callback, None if data is None else decode(data))
+        if data is None:
+            return
+
+
+async def _worker(index: int, inbox: multiprocessing.Queue, outbox: multiprocessing.Queue,
+                  base_factory: Callable[[Any], Any], user_db_factory: Optional[Callable[[], Any]], workers: int,
+                  max_pending: int):
+    connection = _WorkerConnection(index, outbox)
+    user_db = user_db_factory() if user_db_factory else None
+    base = base_factory(user_db)
+    base.states = _SyncedStateStore(connection)
+    finished = asyncio.Event()
+
+    async def handle(message: RemoteMessage):
+        try:
+            await base.message_handler(message)
+        finally:
+            connection.done(message.token)
+
+    # Порядок внутри чата держит локальный диспетчер: все сообщения чата приходят в этот воркер
+    base.dispatcher = Dispatcher(handle, workers=workers, max_pending=max_pending)
+    pending: set[asyncio.Task] = set()
+
+    def receive(item):
+        if item is None:
+            finished.set()
+        elif item[0] == "message":
+            _, token, platform, message, state = item
+            if state is not None:
+                base.states.restore(*state)
+            task = asyncio.create_task(base.dispatch(RemoteMessage(token, message, connection.interface(platform))))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+        elif item[0] == "result":
+            _, call_id, ok, value = item
+            connection.resolve(call_id, ok, value)
+
+    loop = asyncio.get_running_loop()
+    thread = threading.Thread(target=_read, args=(inbox, loop, receive), daemon=True)
+    thread.start()
+    await finished.wait()
+    await asyncio.gather(*pending, return_exceptions=True)
+    await base.dispatcher.join()
+    await base.dispatcher.close()
+    if user_db is not None:
+        await user_db.close()
+
+
+def _worker_main(index: int, inbox: multiprocessing.Queue, outbox: multiprocessing.Queue,
+                 base_factory: Callable[[Any], Any], user_db_factory: Optional[Callable[[], Any]], workers: int,
+                 max_pending: int):
+    try:
+        asyncio.run(_worker(index, inbox, outbox, base_factory, user_db_factory, workers, max_pending))
+    except KeyboardInterrupt:
+        # Остановкой управляет I/O процесс
+        pass
+
+
+class _Live:
+    __slots__ = ("message", "shard", "attachments")
+
+    def __init__(self, message: Message, shard: int):
+        self.message = message
+        self.shard = shard
+        self.attachments: Optional[list[Attachment]] = None
+
+
+class ShardedDispatcher:
+    def __init__(self, base_factory: Callable[[Any], Any] = None, processes: int = None, workers: int = None,
+                 max_pending: int = MAX_PENDING, user_db_factory: Callable[[], Any] = None,
+                 downloader: Callable[[Media], Awaitable] = None, states: StateStore = None):
+        """
+        Замена Dispatcher: обработчики работают в отдельных процессах.
+        Интерфейсы остаются в текущем (I/O) процессе, сообщения одного чата всегда идут в один процесс,
+        поэтому их порядок сохраняется. Ответы и вложения воркеры получают через RPC по токену сообщения.
+        :param base_factory: Создаёт ядро в процессе-воркере по user_db, по умолчанию BaseInterface.
+        Должна импортироваться по имени (spawn)
+        :param processes: Количество процессов, по умолчанию по числу ядер
+        :param workers: Одновременных обработчиков в каждом процессе
+        :param max_pending: Максимум сообщений в обработке, после которого submit ждёт
+        :param user_db_factory: Создаёт user_db в процессе-воркере, например functools.partial(Storage, path,
+        readonly=True). Должна передаваться через pickle (spawn). None - воркеры без истории
+        :param downloader: Скачивание медиа в этом процессе (обычно BaseInterface._download ядра I/O процесса) -
+        воркеры не держат свои хранилища медиа и не гоняют файлы через очереди
+        :param states: Состояния диалогов I/O процесса (обычно BaseInterface.states). Воркеры получают состояние
+        вместе с сообщением и присылают изменения сюда, так что сохранение в файл работает и с шардированием
+        """
+        if base_factory is None:
+            from .interface import BaseInterface
+            base_factory = BaseInterface
+        self.base_factory = base_factory
+        self.user_db_factory = user_db_factory
+        self.downloader = downloader
+        self.states = states
+        self.processes = processes or os.cpu_count() or 1
+        self.workers = workers
+        self.max_pending = max_pending
+        self.processed = 0
+        # Сообщения, потерянные из-за падения процесса-воркера
+        self.lost = 0
+        self.restarts = 0
+        self._tokens = itertools.count()
+        self._live: dict[int, _Live] = {}
+        self._slots = asyncio.Semaphore(max_pending)
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._inboxes: list[multiprocessing.Queue] = []
+        self._outbox: Optional[multiprocessing.Queue] = None
+        self._processes: list[multiprocessing.Process] = []
+        self._calls: set[asyncio.Task] = set()
+        self._reader: Optional[threading.Thread] = None
+        self._watcher: Optional[asyncio.Task] = None
+        self._context = multiprocessing.get_context("spawn")
+
+    key = staticmethod(Dispatcher.key)
+
+    def start(self):
+        if self._processes:
+            return
+        self._outbox = self._context.Queue()
+        for index in range(self.processes):
+            inbox, process = self._spawn(index)
+            self._inboxes.append(inbox)
+            self._processes.append(process)
+        loop = asyncio.get_running_loop()
+        self._reader = threading.Thread(target=_read, args=(self._outbox, loop, self._receive), daemon=True)
+        self._reader.start()
+        self._watcher = asyncio.create_task(self._watch())
+
+    def _spawn(self, index: int) -> tuple[multiprocessing.Queue, multiprocessing.Process]:
+        inbox = self._context.Queue()
+        process = self._context.Process(
+            target=_worker_main, name=f"shard-{index}", daemon=True,
+            args=(index, inbox, self._outbox, self.base_factory, self.user_db_factory, self.workers or 8,
+                  self.max_pending),
+        )
+        process.start()
+        return inbox, process
+
+    async def _watch(self):
+        # Процесс может упасть, не прислав done: его сообщения иначе занимали бы места навсегда
+        while self._processes:
+            processes = list(self._processes)
+            ready = await asyncio.to_thread(multiprocessing.connection.wait,
+                                            [process.sentinel for process in processes], WATCH_INTERVAL)
+            for index, process in enumerate(processes):
+                if process.sentinel in ready and self._processes and self._processes[index] is process:
+                    # Процесс уже вышел, join только забирает код завершения
+                    await asyncio.to_thread(process.join, WATCH_INTERVAL)
+                    self._restart(index, process)
+
+    def _restart(self, index: int, process: multiprocessing.Process):
+        tokens = [token for token, live in self._live.items() if live.shard == index]
+        logging.error("Процесс %s завершился с кодом %s, потеряно сообщений: %s, перезапуск",
+                      process.name, process.exitcode, len(tokens))
+        for token in tokens:
+            self._finish(token)
+        self.lost += len(tokens)
+        self.restarts += 1
+        # Старую очередь больше никто не читает - не ждём её сброса при выходе
+        self._inboxes[index].cancel_join_thread()
+        self._inboxes[index].close()
+        self._inboxes[index], self._processes[index] = self._spawn(index)
+
+    def shard(self, message: Message) -> int:
+        return hash(self.key(message)) % self.processes
+
+    async def submit(self, message: Message):
+        self.start()
+        await self._slots.acquire()
+        token = next(self._tokens)
+        shard = self.shard(message)
+        self._live[token] = _Live(message, shard)
+        self._idle.clear()
+        try:
+            self._inboxes[shard].put(encode(("message", token, message.platform_name(), message,
+                                             self._state(message))))
+        except Exception:
+            self._finish(token)
+            raise
+
+    def _state(self, message: Message) -> Optional[tuple[Hashable, Optional[tuple[str, Any, float]]]]:
+        if self.states is None or message.from_user is None:
+            return None
+        key = StateStore.key(message)
+        return key, self.states.item(key)
+
+    def _finish(self, token: int):
+        if self._live.pop(token, None) is not None:
+            self._slots.release()
+            if not self._live:
+                self._idle.set()
+
+    def _receive(self, item):
+        if item is None:
+            return
+        if item[0] == "done":
+            self.processed += 1
+            self._finish(item[2])
+        elif item[0] == "state":
+            _, _, key, state, data, ttl = item
+            if self.states is None:
+                return
+            if state is None:
+                self.states.pop(key)
+            else:
+                self.states.set(key, state, data, ttl)
+        elif item[0] == "call":
+            task = asyncio.create_task(self._call(*item[1:]))
+            self._calls.add(task)
+            task.add_done_callback(self._calls.discard)
+
+    async def _attachments(self, live: _Live) -> list[Attachment]:
+        if live.attachments is None:
+            live.attachments = list(await live.message.get_attachments())
+        return live.attachments
+
+    async def _localize(self, value: Any) -> Any:
+        # Медиа из воркера заменяются живыми объектами этого процесса
+        if isinstance(value, RemoteMedia):
+            live = self._live.get(value.token)
+            return (await self._attachments(live))[value.index] if live else value.original
+        if isinstance(value, list):
+            return [await self._localize(item) for item in value]
+        return value
+
+    async def _call(self, shard: int, call_id: int, token: int, method: str, args: tuple):
+        try:
+            live = self._live.get(token)
+            if live is None:
+                raise LookupError(f"Сообщение {token} уже обработано")
+            if method == "get_attachments":
+                result = await self._attachments(live)
+            elif method == "media_get":
+                result = await (await self._attachments(live))[args[0]].get()
+            elif method == "media_download":
+                if self.downloader is None:
+                    raise RuntimeError("Скачивание медиа из воркеров не настроено (downloader)")
+                result = await self.downloader((await self._attachments(live))[args[0]])
+            elif method in REMOTE_METHODS:
+                text, attachments = args
+                result = await getattr(live.message, method)(text, await self._localize(attachments))
+                if isinstance(result, Entity):
+                    result = None
+            else:
+                raise ValueError(f"Неизвестный метод {method}")
+            reply = ("result", call_id, True, result)
+        except Exception as e:
+            reply = ("result", call_id, False, _picklable_error(e))
+        try:
+            self._inboxes[shard].put(encode(reply))
+        except Exception as e:
+            self._inboxes[shard].put(encode(("result", call_id, False, _picklable_error(e))))
+
+    def depth(self, key: Optional[Hashable] = None) -> int:
+        return len(self._live)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "processes": self.processes,
+            "alive": sum(process.is_alive() for process in self._processes),
+            "pending": len(self._live),
+            "calls": len(self._calls),
+            "processed": self.processed,
+            "lost": self.lost,
+            "restarts": self.restarts,
+        }
+
+    async def join(self):
+        await self._idle.wait()
+
+    async def close(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+            self._watcher = None
+        for inbox in self._inboxes:
+            inbox.put(None)
+        await asyncio.gather(*(asyncio.to_thread(process.join) for process in self._processes))
+        if self._outbox is not None:
+            self._outbox.put(None)
+        for task in self._calls:
+            task.cancel()
+        self._inboxes, self._processes, self._outbox = [], [], None
@@ -0,0 +1,172 @@
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import os
+import time
+from typing import Any, Hashable, Optional
+
+from .types import Message
+
+STATE_TTL = 600.0
+# Изменения за это время сохраняются в файл одной записью
+SAVE_DELAY = 1.0
+
+StateKey = tuple[Optional[str], Optional[int], Optional[int]]
+
+
+class StateStore:
+    def __init__(self, ttl: float = STATE_TTL, path: str = None, save_delay: float = SAVE_DELAY):
+        """
+        Состояния диалогов (например, "ждём медиа") с временем жизни.
+        Поиск - одно обращение к словарю, устаревшие записи удаляются по мере записи новых.
+        :param ttl: Время жизни состояния в секундах по умолчанию
+        :param path: JSON файл для сохранения между перезапусками, None - только в памяти
+        :param save_delay: Через сколько секунд после изменения сохранять файл
+        """
+        self.ttl = ttl
+        self.path = path
+        self.save_delay = save_delay
+        self._save_handle: Optional[asyncio.TimerHandle] = None
+        self._saving: Optional[asyncio.Future] = None
+        self._states: dict[Hashable, tuple[str, Any, float]] = {}
+        self._expiry: list[tuple[float, int, Hashable]] = []
+        self._counter = itertools.count()
+        if path:
+            self.load()
+
+    @staticmethod
+    def key(message: Message) -> StateKey:
+        """
+        Ключ состояния для пользователя в конкретном чате.
+        """
+        chat = message.chat
+        return getattr(chat, "platform", None), chat.id if chat else None, message.from_user.id
+
+    def __len__(self):
+        return len(self._states)
+
+    def get(self, key: Hashable) -> Optional[str]:
+        item = self._states.get(key)
+        if item is None:
+            return None
+        if item[2] <= time.time():
+            del self._states[key]
+            return None
+        return item[0]
+
+    def item(self, key: Hashable) -> Optional[tuple[str, Any, float]]:
+        """
+        Состояние, данные и время окончания (time.time()) - для передачи в другой процесс.
+        """
+        return self._states[key] if self.get(key) is not None else None
+
+    def get_data(self, key: Hashable) -> Any:
+        return self._states[key][1] if self.get(key) is not None else None
+
+    def set(self, key: Hashable, state: str, data: Any = None, ttl: float = None):
+        """
+        Устанавливает состояние.
+        :param key: Ключ, обычно StateStore.key(message)
+        :param state: Название состояния
+        :param data: Дополнительные данные, при сохранении в файл должны сериализоваться в JSON
+        :param ttl: Время жизни в секундах, по умолчанию общее
+        """
+        self.purge()
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        self._states[key] = (state, data, expires)
+        heapq.heappush(self._expiry, (expires, next(self._counter), key))
+        self._schedule_save()
+
+    def pop(self, key: Hashable) -> Optional[str]:
+        state = self.get(key)
+        if self._states.pop(key, None) is not None:
+            self._schedule_save()
+        return state
+
+    def purge(self) -> int:
+        """
+        Удаляет устаревшие состояния.
+        :return: Сколько удалено
+        """
+        now = time.time()
+        removed = 0
+        while self._expiry and self._expiry[0][0] <= now:
+            expires, _, key = heapq.heappop(self._expiry)
+            item = self._states.get(key)
+            # Запись могла быть перезаписана с другим сроком
+            if item is not None and item[2] == expires:
+                del self._states[key]
+                removed += 1
+        return removed
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                items = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        for key, state, data, expires in items:
+            if expires > now:
+                key = tuple(key)
+                self._states[key] = (state, data, expires)
+                heapq.heappush(self._expiry, (expires, next(self._counter), key))
+
+    def _schedule_save(self):
+        if not self.path or self._save_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Вне цикла событий сохраняет только close/save
+            return
+        self._save_handle = loop.call_later(self.save_delay, self._save_later)
+
+    def _save_later(self):
+        loop = asyncio.get_running_loop()
+        if self._saving is not None and not self._saving.done():
+            # Предыдущая запись ещё идёт - сохраним после неё
+            self._save_handle = loop.call_later(self.save_delay, self._save_later)
+            return
+        self._save_handle = None
+        # Снимок берётся в цикле событий, запись файла - в потоке
+        items = self._snapshot()
+        self._saving = loop.run_in_executor(None, _write, self.path, items)
+        self._saving.add_done_callback(_log_error)
+
+    def _snapshot(self) -> list:
+        self.purge()
+        return [[list(key), state, data, expires] for key, (state, data, expires) in self._states.items()]
+
+    def save(self):
+        if not self.path:
+            return
+        _write(self.path, self._snapshot())
+
+    async def close(self):
+        """
+        Сохраняет состояния сразу, не дожидаясь отложенного сохранения. Вызывается при остановке.
+        """
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._save_handle = None
+        if self._saving is not None:
+            # Иначе запись старого снимка может закончиться позже и перезаписать файл
+            await asyncio.wait([self._saving])
+            self._saving = None
+        if self.path:
+            await asyncio.to_thread(_write, self.path, self._snapshot())
+
+
+def _write(path: str, items: list):
+    temp = path + ".tmp"
+    with open(temp, "w", encoding="utf-8") as f:
+        json.dump(items, f)
+    os.replace(temp, path)
+
+
+def _log_error(future: asyncio.Future):
+    if not future.cancelled() and future.exception() is not None:
+        logging.error("Не удалось сохранить состояния: %s", future.exception())
@@ -0,0 +1,349 @@
+import asyncio
+import concurrent.futures
+import datetime
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+
+from .cache import TTLCache
+from .types import Chat, Message
+
+DB_PATH = "bot.db"
+BATCH_SIZE = 500
+# Сколько секунд копить записи перед общей фиксацией транзакции
+FLUSH_INTERVAL = 0.5
+SEEN_CACHE_SIZE = 10000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    platform TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    first_name TEXT,
+    last_name TEXT,
+    username TEXT,
+    is_bot INTEGER,
+    updated REAL NOT NULL,
+    PRIMARY KEY (platform, id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS chats (
+    platform TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    type TEXT,
+    title TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (platform, id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS messages (
+    rowid INTEGER PRIMARY KEY,
+    platform TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    user_id INTEGER,
+    date REAL NOT NULL,
+    text TEXT,
+    attachments INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (platform, chat_id, id)
+);
+
+CREATE INDEX IF NOT EXISTS messages_chat_date ON messages (platform, chat_id, date);
+CREATE INDEX IF NOT EXISTS messages_user ON messages (platform, user_id);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 (
+    text, content = 'messages', content_rowid = 'rowid', tokenize = 'unicode61 remove_diacritics 2'
+);
+
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, text) VALUES (new.rowid, new.text);
+END;
+
+CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+END;
+"""
+SEARCH_LIMIT = 20
+
+UPSERT_USER = """
+INSERT INTO users (platform, id, first_name, last_name, username, is_bot, updated) VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (platform, id) DO UPDATE SET first_name = excluded.first_name, last_name = excluded.last_name,
+    username = excluded.username, is_bot = excluded.is_bot, updated = excluded.updated
+"""
+UPSERT_CHAT = """
+INSERT INTO chats (platform, id, type, title, updated) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (platform, id) DO UPDATE SET type = excluded.type, title = excluded.title, updated = excluded.updated
+"""
+INSERT_MESSAGE = """
+INSERT OR IGNORE INTO messages (platform, chat_id, id, user_id, date, text, attachments) VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+_STOP = object()
+
+
+def connect(path: str, readonly: bool = False, check_same_thread: bool = True) -> sqlite3.Connection:
+    if readonly:
+        # Режим WAL уже включён пишущим процессом, читателю менять настройки базы не нужно
+        connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=check_same_thread)
+        connection.row_factory = sqlite3.Row
+        return connection
+    connection = sqlite3.connect(path, check_same_thread=check_same_thread)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")
+    # В WAL режиме NORMAL не теряет целостность, только последние транзакции при сбое питания
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+
+class Storage:
+    def __init__(self, path: str = DB_PATH, batch_size: int = BATCH_SIZE, flush_interval: float = FLUSH_INTERVAL,
+                 readonly: bool = False):
+        """
+        Локальная история: пользователи, чаты и сообщения в SQLite (WAL).
+        Запись не ждёт диска: строки копятся в очереди и фиксируются пачками в отдельном потоке.
+        Чтение идёт из пула потоков, по соединению на поток - WAL позволяет читать во время записи.
+        :param path: Файл базы
+        :param batch_size: Максимум строк в одной транзакции
+        :param flush_interval: Сколько секунд ждать остальные строки пачки после первой
+        :param readonly: Только чтение (процессы-воркеры ShardedDispatcher): store_message ничего не делает,
+        запись ведёт процесс, создавший базу
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.readonly = readonly
+        self.written = 0
+        self.batches = 0
+        # Пользователи и чаты без изменений не перезаписываются на каждое сообщение
+        self._seen = TTLCache(maxsize=SEEN_CACHE_SIZE, ttl=None)
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._local = threading.local()
+        # Соединения потоков чтения - закрываются в close()
+        self._readers: list[sqlite3.Connection] = []
+        self._readers_lock = threading.Lock()
+        self._writer: Optional[threading.Thread] = None
+        if readonly:
+            return
+
+        connection = connect(path)
+        has_index = connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone() is not None
+        connection.executescript(SCHEMA)
+        if not has_index:
+            # База из версии без поиска - индексируем уже сохранённые сообщения
+            with connection:
+                connection.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+        connection.close()
+        self._writer = threading.Thread(target=self._write_loop, name="storage-writer", daemon=True)
+        self._writer.start()
+
+    # Запись
+
+    def _changed(self, key: tuple, row: tuple) -> bool:
+        if self._seen.get(key, count=False) == row:
+            return False
+        self._seen.set(key, row)
+        return True
+
+    def store_message(self, message: Message):
+        """
+        Ставит сообщение (и его автора и чат) в очередь записи. Не блокирует.
+        """
+        if self.readonly:
+            return
+        user = message.from_user
+        chat = message.chat
+        platform = message.platform_name() or getattr(chat, "platform", None) or getattr(user, "platform", None)
+        now = time.time()
+        if user is not None:
+            row = (platform, user.id, user.first_name, user.last_name, user.username, int(bool(user.is_bot)))
+            if self._changed(("user", platform, user.id), row):
+                self._queue.put((UPSERT_USER, row + (now,)))
+        if chat is not None:
+            chat_type = getattr(chat.type, "value", chat.type)
+            row = (platform, chat.id, chat_type, chat.title)
+            if self._changed(("chat", platform, chat.id), row):
+                self._queue.put((UPSERT_CHAT, row + (now,)))
+        date = message.date.timestamp() if message.date else now
+        self._queue.put((INSERT_MESSAGE, (platform, chat.id if chat else None, message.id,
+                                          user.id if user else None, date, message.text,
+                                          len(message.attachments or ()))))
+
+    def _write_loop(self):
+        connection = connect(self.path)
+        try:
+            while True:
+                item = self._queue.get()
+                if item is _STOP:
+                    return
+                batch = [item]
+                deadline = time.monotonic() + self.flush_interval
+                stop = False
+                # Запрос flush - фиксируем сразу, не дожидаясь остальных строк
+                while len(batch) < self.batch_size and not isinstance(batch[-1], concurrent.futures.Future):
+                    try:
+                        item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                    except queue.Empty:
+                        break
+                    if item is _STOP:
+                        stop = True
+                        break
+                    batch.append(item)
+                self._commit(connection, batch)
+                if stop:
+                    return
+        finally:
+            connection.close()
+
+    def _commit(self, connection: sqlite3.Connection, batch: list):
+        waiters = [item for item in batch if isinstance(item, concurrent.futures.Future)]
+        rows = [item for item in batch if not isinstance(item, concurrent.futures.Future)]
+        try:
+            with connection:
+                self._execute(connection, rows)
+            self.written += len(rows)
+            self.batches += 1
+        except sqlite3.Error as e:
+            # Одна плохая строка не должна терять всю пачку - пишем по одной
+            logging.warning("Пачка из %s строк не записана (%s), пишем по одной", len(rows), e)
+            for sql, params in rows:
+                try:
+                    with connection:
+                        connection.execute(sql, params)
+                    self.written += 1
+                except sqlite3.Error as e:
+                    logging.error("Не удалось записать строку в %s: %s", self.path, e)
+        for waiter in waiters:
+            waiter.set_result(None)
+
+    def _execute(self, connection: sqlite3.Connection, rows: list[tuple[str, tuple]]):
+        # Подряд идущие одинаковые запросы - одним executemany
+        start = 0
+        while start < len(rows):
+            sql = rows[start][0]
+            end = start
+            while end < len(rows) and rows[end][0] is sql:
+                end += 1
+            connection.executemany(sql, [params for _, params in rows[start:end]])
+            start = end
+
+    async def flush(self):
+        """
+        Ждёт записи всего, что уже поставлено в очередь.
+        """
+        if self._writer is None:
+            return
+        future = concurrent.futures.Future()
+        self._queue.put(future)
+        await asyncio.wrap_future(future)
+
+    async def close(self):
+        if self._writer is not None:
+            await self.flush()
+            self._queue.put(_STOP)
+            await asyncio.to_thread(self._writer.join)
+            self._writer = None
+        with self._readers_lock:
+            readers, self._readers = self._readers, []
+        for connection in readers:
+            connection.close()
+
+    # Чтение
+
+    def _reader(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Закрывается из другого потока (close), поэтому без check_same_thread - сам поток держит его один
+            connection = self._local.connection = connect(self.path, self.readonly, check_same_thread=False)
+            with self._readers_lock:
+                self._readers.append(connection)
+        return connection
+
+    def _fetch(self, sql: str, params: tuple) -> list[dict[str, Any]]:
+        return [dict(row) for row in self._reader().execute(sql, params)]
+
+    async def fetch(self, sql: str, *params) -> list[dict[str, Any]]:
+        return await asyncio.to_thread(self._fetch, sql, params)
+
+    async def get_user(self, platform: str, id: int) -> Optional[dict[str, Any]]:
+        rows = await self.fetch("SELECT * FROM users WHERE platform = ? AND id = ?", platform, id)
+        return rows[0] if rows else None
+
+    async def get_chat(self, platform: str, id: int) -> Optional[dict[str, Any]]:
+        rows = await self.fetch("SELECT * FROM chats WHERE platform = ? AND id = ?", platform, id)
+        return rows[0] if rows else None
+
+    async def get_messages(self, platform: str, chat_id: int, limit: int = 100,
+                           before: float = None) -> list[dict[str, Any]]:
+        """
+        История чата от новых сообщений к старым.
+        :param before: Только сообщения раньше этого времени (timestamp) - для постраничного чтения
+        """
+        return await self.fetch(
+            "SELECT * FROM messages WHERE platform = ? AND chat_id = ? AND date < ? ORDER BY date DESC LIMIT ?",
+            platform, chat_id, float("inf") if before is None else before, limit,
+        )
+
+    async def get_user_messages(self, platform: str, user_id: int, limit: int = 100) -> list[dict[str, Any]]:
+        return await self.fetch(
+            "SELECT * FROM messages WHERE platform = ? AND user_id = ? ORDER BY rowid DESC LIMIT ?",
+            platform, user_id, limit,
+        )
+
+    async def count_messages(self, platform: str, chat_id: int = None, user_id: int = None) -> int:
+        sql = "SELECT count(*) AS count FROM messages WHERE platform = ?"
+        params = [platform]
+        if chat_id is not None:
+            sql += " AND chat_id = ?"
+            params.append(chat_id)
+        if user_id is not None:
+            sql += " AND user_id = ?"
+            params.append(user_id)
+        return (await self.fetch(sql, *params))[0]["count"]
+
+    @staticmethod
+    def _match(query: str) -> str:
+        # Каждое слово - отдельная фраза в кавычках: все слова обязательны, синтаксис FTS5 в запросе не работает
+        return " ".join('"' + word.replace('"', '""') + '"' for word in query.split())
+
+    async def search(self, query: str, chat: Chat = None, since: datetime.datetime | float = None,
+                     platform: str = None, limit: int = SEARCH_LIMIT) -> list[dict[str, Any]]:
+        """
+        Полнотекстовый поиск по сохранённым сообщениям, новые первыми.
+        Индекс (FTS5) обновляется триггером в той же транзакции, что и запись сообщения.
+        :param query: Слова для поиска, все должны встретиться в тексте
+        :param chat: Искать только в этом чате
+        :param since: Только сообщения не раньше этого времени
+        :param platform: Только сообщения этой платформы (по умолчанию - платформа чата, если он указан)
+        :param limit: Максимум результатов
+        :return: Строки messages и snippet - фрагмент текста с найденными словами в [скобках]
+        """
+        match = self._match(query)
+        if not match:
+            return []
+        sql = ("SELECT messages.*, snippet(messages_fts, 0, '[', ']', '…', 12) AS snippet FROM messages_fts "
+               "JOIN messages ON messages.rowid = messages_fts.rowid WHERE messages_fts MATCH ?")
+        params: list[Any] = [match]
+        if chat is not None:
+            platform = platform or chat.platform_name()
+            sql += " AND messages.chat_id = ?"
+            params.append(chat.id)
+        if platform is not None:
+            sql += " AND messages.platform = ?"
+            params.append(platform)
+        if since is not None:
+            sql += " AND messages.date >= ?"
+            params.append(since.timestamp() if isinstance(since, datetime.datetime) else since)
+        # Новые первыми: FTS5 идёт по rowid и останавливается на limit, без оценки всех совпадений
+        sql += " ORDER BY messages_fts.rowid DESC LIMIT ?"
+        params.append(limit)
+        return await self.fetch(sql, *params)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "batches": self.batches,
+        }
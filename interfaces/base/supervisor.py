@@ -0,0 +1,203 @@
+import asyncio
+import enum
+import logging
+import signal
+import time
+from typing import Any, Awaitable, Callable, Coroutine, Optional
+
+RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 60.0
+# Задача, проработавшая дольше, считается стабильной - задержка перезапуска сбрасывается
+STABLE_AFTER = 60.0
+SHUTDOWN_TIMEOUT = 30.0
+
+
+class Health(enum.Enum):
+    STARTING = "starting"
+    RUNNING = "running"
+    BACKOFF = "backoff"
+    STOPPED = "stopped"
+    FAILED = "failed"
+
+
+class SupervisedTask:
+    def __init__(self, name: str, factory: Callable[[], Awaitable], on_stop: Callable[[], Awaitable] = None,
+                 on_pause: Callable[[], Awaitable] = None):
+        """
+        Задача под наблюдением супервизора.
+        :param name: Название для логов и health
+        :param factory: Функция без аргументов, возвращающая корутину; вызывается заново при каждом перезапуске
+        :param on_stop: Вызывается при остановке супервизора, после обработки принятых сообщений
+        :param on_pause: Вызывается первым при остановке - прекращает приём новых сообщений
+        """
+        self.name = name
+        self.factory = factory
+        self.on_stop = on_stop
+        self.on_pause = on_pause
+        self.state = Health.STARTING
+        self.restarts = 0
+        self.last_error: Optional[str] = None
+        self.started_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def health(self) -> dict[str, Any]:
+        return {
+            "state": self.state.value,
+            "restarts": self.restarts,
+            "last_error": self.last_error,
+            "uptime": time.monotonic() - self.started_at if self.state is Health.RUNNING else 0.0,
+        }
+
+
+class Supervisor:
+    def __init__(self, base_interface: Any = None, restart_delay: float = RESTART_DELAY,
+                 max_restart_delay: float = MAX_RESTART_DELAY, max_restarts: int = None,
+                 shutdown_timeout: float = SHUTDOWN_TIMEOUT):
+        """
+        Запускает задачи (обычно Interface.start) в одном цикле событий и перезапускает упавшие
+        с растущей задержкой, не затрагивая остальные.
+        :param base_interface: Ядро, чьи обработчики дорабатываются при остановке
+        :param restart_delay: Первая задержка перезапуска в секундах, дальше удваивается
+        :param max_restart_delay: Максимальная задержка перезапуска
+        :param max_restarts: После стольких перезапусков подряд задача считается FAILED, None - без ограничения
+        :param shutdown_timeout: Сколько ждать завершения обработчиков при остановке
+        """
+        self.base_interface = base_interface
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.max_restarts = max_restarts
+        self.shutdown_timeout = shutdown_timeout
+        self.tasks: dict[str, SupervisedTask] = {}
+        self._stopping = asyncio.Event()
+
+    def add(self, name: str, factory: Callable[[], Awaitable], on_stop: Callable[[], Awaitable] = None,
+            on_pause: Callable[[], Awaitable] = None):
+        """
+        Запускает задачу под наблюдением. Вызывается внутри работающего цикла событий.
+        """
+        entry = self.tasks[name] = SupervisedTask(name, factory, on_stop, on_pause)
+        if not self._stopping.is_set():
+            entry.task = asyncio.create_task(self._supervise(entry), name=f"supervised:{name}")
+        return entry
+
+    def supervise(self, interface: Any, factory: Callable[[], Awaitable] = None):
+        """
+        Наблюдение за интерфейсом: по умолчанию перезапускается connect и start.
+        При остановке сначала вызывается pause, затем, после обработки принятых сообщений, stop.
+        """
+
+        async def run():
+            await interface.connect()
+            await interface.start()
+
+        return self.add(type(interface).__name__, factory or run, interface.stop, interface.pause)
+
+    async def _supervise(self, entry: SupervisedTask):
+        delay = self.restart_delay
+        failures = 0
+        while not self._stopping.is_set():
+            entry.state = Health.RUNNING
+            entry.started_at = time.monotonic()
+            try:
+                await entry.factory()
+                logging.warning("%s завершился, перезапуск", entry.name)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                entry.last_error = f"{type(e).__name__}: {e}"
+                logging.exception("%s упал", entry.name)
+
+            if self._stopping.is_set():
+                break
+            if time.monotonic() - entry.started_at >= STABLE_AFTER:
+                delay = self.restart_delay
+                failures = 0
+            failures += 1
+            if self.max_restarts is not None and failures > self.max_restarts:
+                entry.state = Health.FAILED
+                logging.error("%s: превышено число перезапусков (%s)", entry.name, self.max_restarts)
+                return
+
+            entry.state = Health.BACKOFF
+            entry.restarts += 1
+            logging.info("%s: перезапуск через %.1f с", entry.name, delay)
+            try:
+                await asyncio.wait_for(self._stopping.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            delay = min(delay * 2, self.max_restart_delay)
+        entry.state = Health.STOPPED
+
+    def health(self) -> dict[str, dict[str, Any]]:
+        return {name: entry.health() for name, entry in self.tasks.items()}
+
+    def request_stop(self):
+        self._stopping.set()
+
+    async def wait(self):
+        """
+        Работает до request_stop (или SIGINT/SIGTERM), затем останавливает всё.
+        """
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.request_stop)
+            except (NotImplementedError, RuntimeError):
+                # Windows и не главный поток
+                pass
+        try:
+            await self._stopping.wait()
+        finally:
+            await self.shutdown()
+
+    async def shutdown(self):
+        """
+        Останавливает приём, дожидается уже принятых сообщений и закрывает интерфейсы.
+        Задачи отменяются только после обработки: отмена start отключает клиента (Telethon отключается
+        в finally run_until_disconnected), а обработчикам ещё нужно отвечать.
+        """
+        self._stopping.set()
+        for entry in self.tasks.values():
+            if entry.on_pause:
+                try:
+                    await entry.on_pause()
+                except Exception as e:
+                    logging.error("Ошибка при остановке приёма %s: %s", entry.name, e)
+
+        dispatcher = getattr(self.base_interface, "dispatcher", None)
+        if dispatcher is not None:
+            try:
+                await asyncio.wait_for(dispatcher.join(), self.shutdown_timeout)
+            except asyncio.TimeoutError:
+                logging.warning("Не все сообщения обработаны за %s с: %s", self.shutdown_timeout, dispatcher.stats())
+
+        tasks = [entry.task for entry in self.tasks.values() if entry.task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        for entry in self.tasks.values():
+            if entry.on_stop:
+                try:
+                    await entry.on_stop()
+                except Exception as e:
+                    logging.error("Ошибка при остановке %s: %s", entry.name, e)
+            entry.state = Health.STOPPED
+
+        if dispatcher is not None:
+            await dispatcher.close()
+
+
+def run(main: Coroutine, use_uvloop: bool = True) -> Any:
+    """
+    Запускает корутину в новом цикле событий, uvloop - если установлен.
+    """
+    loop_factory = None
+    if use_uvloop:
+        try:
+            import uvloop
+            loop_factory = uvloop.new_event_loop
+        except ImportError:
+            pass
+    with asyncio.Runner(loop_factory=loop_factory) as runner:
+        return runner.run(main)
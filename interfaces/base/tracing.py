@@ -0,0 +1,170 @@
+import bisect
+import functools
+import os
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+# Границы корзин гистограммы в секундах, как в Prometheus (le)
+BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRIC = "multiinterfacesbot_span_seconds"
+
+
+class Histogram:
+    __slots__ = ("counts", "count", "sum", "errors")
+
+    def __init__(self):
+        """
+        Распределение длительностей по корзинам BUCKETS (последняя - +Inf).
+        """
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.errors = 0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q: float) -> float:
+        """
+        Оценка квантиля по корзинам: верхняя граница корзины, в которую он попадает.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        total = 0
+        for index, count in enumerate(self.counts):
+            total += count
+            if total >= rank:
+                return BUCKETS[index] if index < len(BUCKETS) else float("inf")
+        return float("inf")
+
+
+class _Span:
+    __slots__ = ("histogram", "started")
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started)
+        if exc_type is not None:
+            self.histogram.errors += 1
+        return False
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+class Tracer:
+    def __init__(self, enabled: bool = False):
+        """
+        Замеры длительности этапов обработки (span) в гистограммы.
+        Выключенный трассировщик возвращает один и тот же пустой span - без замеров и форматирования строк.
+        :param enabled: Включён ли сбор
+        """
+        self.enabled = enabled
+        self.histograms: dict[tuple[str, Optional[str]], Histogram] = {}
+
+    def span(self, name: str, kind: str = None) -> _Span | _NoopSpan:
+        """
+        Контекстный менеджер, замеряющий блок.
+        :param name: Этап: receive, transform, from_tl, command, handler, send
+        :param kind: Уточнение этапа (тип объекта, имя команды). Передаётся как есть, без f-строк
+        """
+        if not self.enabled:
+            return _NOOP
+        key = (name, kind)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        return _Span(histogram)
+
+    def traced(self, name: str, kind: str = None) -> Callable:
+        """
+        Декоратор для корутин: весь вызов - один span.
+        """
+
+        def decorator(func: Callable[..., Awaitable]):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return await func(*args, **kwargs)
+                with self.span(name, kind):
+                    return await func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def reset(self):
+        self.histograms.clear()
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        result = {}
+        items = sorted(self.histograms.items(), key=lambda item: (item[0][0], item[0][1] or ""))
+        for (name, kind), histogram in items:
+            result[name if kind is None else f"{name}.{kind}"] = {
+                "count": histogram.count,
+                "errors": histogram.errors,
+                "avg": histogram.sum / histogram.count if histogram.count else 0.0,
+                "p50": histogram.quantile(0.5),
+                "p99": histogram.quantile(0.99),
+            }
+        return result
+
+    def summary(self) -> str:
+        """
+        Текст для команды /stats.
+        """
+        if not self.enabled:
+            return "Трассировка выключена (TRACING=1)."
+        stats = self.stats()
+        if not stats:
+            return "Замеров пока нет."
+        lines = []
+        for name, item in stats.items():
+            lines.append(f"{name}: {item['count']} шт., ошибок {item['errors']}, "
+                         f"сред. {item['avg'] * 1000:.2f} мс, p50 ≤ {item['p50'] * 1000:g} мс, "
+                         f"p99 ≤ {item['p99'] * 1000:g} мс")
+        return "\n".join(lines)
+
+    def prometheus(self) -> str:
+        """
+        Гистограммы в текстовом формате Prometheus.
+        """
+        lines = [f"# HELP {METRIC} Длительность этапов обработки сообщений", f"# TYPE {METRIC} histogram"]
+        for (name, kind), histogram in self.histograms.items():
+            labels = f'span="{name}"' + (f',kind="{_escape(kind)}"' if kind is not None else "")
+            total = 0
+            for bound, count in zip(BUCKETS + (float("inf"),), histogram.counts):
+                total += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{METRIC}_bucket{{{labels},le="{le}"}} {total}')
+            lines.append(f"{METRIC}_sum{{{labels}}} {histogram.sum}")
+            lines.append(f"{METRIC}_count{{{labels}}} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# Общий трассировщик процесса, включается переменной окружения TRACING=1
+tracer = Tracer(enabled=os.getenv("TRACING") == "1")
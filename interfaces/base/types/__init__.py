@@ -1,7 +1,11 @@
 from .t import (
+    CHUNK_SIZE,
+    Lazy,
     ChatType,
+    AttachmentKind,
     Entity,
     Attachment,
+    LazyAttachment,
     Media,
     Sticker,
     AnimatedSticker,
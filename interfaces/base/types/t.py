@@ -1,9 +1,13 @@
+import asyncio
 import datetime
 import enum
 from abc import ABC, abstractmethod
-from typing import Optional
+from typing import Any, AsyncIterator, Awaitable, Callable, Hashable, Optional
 
 BLOCK_VARS = ["source", "caller"]
+_FIELDS: dict[type, tuple[str, ...]] = {}
+_COMPARED_FIELDS: dict[type, tuple[str, ...]] = {}
+CHUNK_SIZE = 512 * 1024
 
 
 def format_bytes(size):
@@ -16,6 +20,80 @@ def format_bytes(size):
     return f"{size:.2f} {power_labels[n]}B"
 
 
+async def _ready(value: Any) -> Any:
+    return value
+
+
+class Lazy:
+    __slots__ = ("key", "_factory", "_task", "_value", "_resolved")
+
+    def __init__(self, factory: Callable[[], Awaitable[Any]], key: Hashable = None):
+        """
+        Отложенное значение, которое вычисляется только при первом await.
+        :param factory: Функция без аргументов, возвращающая корутину
+        :param key: Идентификатор значения, доступный без вычисления
+        """
+        self.key = key
+        self._factory = factory
+        self._task: Optional[asyncio.Future] = None
+        self._value: Any = None
+        self._resolved = False
+
+    @classmethod
+    def resolved_with(cls, value: Any, key: Hashable = None) -> "Lazy":
+        lazy = cls(None, key)
+        lazy._value = value
+        lazy._resolved = True
+        return lazy
+
+    @property
+    def resolved(self) -> bool:
+        return self._resolved
+
+    async def get(self) -> Any:
+        if self._resolved:
+            return self._value
+
+        if self._factory is None and self._task is None:
+            raise LookupError(f"Значение {self.key!r} недоступно: объект получен из другого процесса")
+        # Одновременные ожидающие получают одну и ту же задачу
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._factory())
+        try:
+            self._value = await asyncio.shield(self._task)
+        except Exception:
+            # Даём возможность повторить запрос
+            self._task = None
+            raise
+        self._resolved = True
+        self._factory = self._task = None
+        return self._value
+
+    def __await__(self):
+        return self.get().__await__()
+
+    def __eq__(self, other):
+        if isinstance(other, Lazy):
+            if self.key is not None and other.key is not None:
+                return self.key == other.key
+            return self._resolved and other._resolved and self._value == other._value
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __reduce__(self):
+        # Фабрика (замыкание над клиентом) в другой процесс не передаётся, только готовое значение
+        if self._resolved:
+            return Lazy.resolved_with, (self._value, self.key)
+        return Lazy, (None, self.key)
+
+    def __repr__(self):
+        if self._resolved:
+            return f"Lazy({self._value!r})"
+        return f"Lazy(key={self.key!r})"
+
+
 class ChatType(enum.Enum):
     """
     Типы чатов.
@@ -26,7 +104,26 @@ class ChatType(enum.Enum):
     CHANNEL = "channel"
 
 
+class AttachmentKind(enum.Enum):
+    """
+    Типы вложений, известные без полного преобразования.
+    """
+    PHOTO = "photo"
+    VIDEO = "video"
+    AUDIO = "audio"
+    DOCUMENT = "document"
+    STICKER = "sticker"
+    ANIMATED_STICKER = "animated_sticker"
+    POLL = "poll"
+    GEO = "geo"
+    VENUE = "venue"
+    CONTACT = "contact"
+    UNSUPPORTED = "unsupported"
+
+
 class Entity:
+    __slots__ = ("id", "source", "caller", "__weakref__")
+
     def __init__(self, id: int, source: object = None, caller: object = None):
         """
         Базовый класс для всех сущностей.
@@ -34,44 +131,111 @@ class Entity:
         :param source: Если преобразовано из другого типа данных, то указывается он
         :param caller: Интерфейс, создавший этот объект
         """
+        if source is not None and not self.source_required and not getattr(caller, "keep_source", True):
+            source = None
         self.id = id
         self.source = source
         self.caller = caller
 
+    # Нужен ли source для работы самой сущности (например, для скачивания файла)
+    source_required = False
+
+    @classmethod
+    def fields(cls) -> tuple[str, ...]:
+        """
+        Имена атрибутов сущности по всей иерархии (из __slots__), без source и caller.
+        """
+        fields = _FIELDS.get(cls)
+        if fields is None:
+            names = []
+            for klass in reversed(cls.__mro__):
+                slots = klass.__dict__.get("__slots__", ())
+                for name in (slots,) if isinstance(slots, str) else slots:
+                    if name not in names and name not in BLOCK_VARS and name != "__weakref__":
+                        names.append(name)
+            fields = _FIELDS[cls] = tuple(names)
+        return fields
+
+    def _items(self):
+        for name in self.fields():
+            yield name, getattr(self, name, None)
+        # Подклассы без __slots__
+        yield from getattr(self, "__dict__", {}).items()
+
     def __str__(self):
-        attrs = vars(self)
-        attr_str = ', '.join(f'{key}={value!r}' for key, value in attrs.items() if key != 'source' and key != 'caller')
+        attr_str = ', '.join(f'{key}={value!r}' for key, value in self._items() if not key.startswith("_"))
         return f'{self.__class__.__name__}({attr_str})'
 
     def __repr__(self):
         return str(self)
 
+    @classmethod
+    def _compared_fields(cls) -> tuple[str, ...]:
+        fields = _COMPARED_FIELDS.get(cls)
+        if fields is None:
+            fields = _COMPARED_FIELDS[cls] = tuple(name for name in cls.fields() if not name.startswith("_"))
+        return fields
+
+    def diff(self, other: "Entity") -> dict[str, tuple[Any, Any]]:
+        """
+        Полная разница между сущностями.
+        :return: {атрибут: (значение у self, значение у other)} для всех отличающихся атрибутов
+        """
+        diff = {}
+        for key in self._compared_fields():
+            value1 = getattr(self, key, None)
+            value2 = getattr(other, key, None)
+            if value1 != value2:
+                diff[key] = (value1, value2)
+
+        dict1 = getattr(self, "__dict__", {})
+        dict2 = getattr(other, "__dict__", {})
+        for key in dict1:
+            if key in dict2 and dict1[key] != dict2[key] and not key.startswith("_") and key not in BLOCK_VARS:
+                diff[key] = (dict1[key], dict2[key])
+        return diff
+
     def __xor__(self, other):
         if isinstance(other, self.__class__):
-            diff = {}
-            dict1 = vars(self)
-            dict2 = vars(other)
-            for key in dict1:
-                try:
-                    if dict1[key] != dict2[key] and not key.startswith("_") and key not in BLOCK_VARS:
-                        diff[key] = (dict1[key], dict2[key])
-                except KeyError:
-                    continue
-            return diff
+            return self.diff(other)
 
         return NotImplemented
 
     def __eq__(self, other):
-        if isinstance(other, self.__class__):
-            return (self ^ other) == {}
-        return NotImplemented
+        if type(other) is not type(self):
+            return NotImplemented
+        if other is self:
+            return True
+
+        # Останавливаемся на первом отличии
+        for key in self._compared_fields():
+            if getattr(self, key, None) != getattr(other, key, None):
+                return False
+        if hasattr(self, "__dict__"):
+            return not self.diff(other)
+        return True
+
+    def __hash__(self):
+        return hash((self.platform_name(), type(self).__name__, self.id))
+
+    def __getstate__(self):
+        # source и caller - живые объекты процесса (клиент, TL-объекты), при сериализации отбрасываются
+        state = {name: getattr(self, name) for name in self.fields() if hasattr(self, name)}
+        state["source"] = state["caller"] = None
+        return getattr(self, "__dict__", None), state
+
+    def platform_name(self) -> Optional[str]:
+        """
+        Платформа сущности: собственный атрибут platform или платформа интерфейса, создавшего её.
+        """
+        return getattr(self, "platform", None) or getattr(self.caller, "platform", None)
 
 
 class Attachment(Entity):
     """
     Базовый класс для всех типов вложений.
     """
-    pass
+    __slots__ = ()
 
 
 class Unsupported(Attachment):
@@ -79,9 +243,44 @@ class Unsupported(Attachment):
     Класс для вложений, которые не поддерживаются в данный момент.
     Есть ряд функций которые реализовываться не будут из-за их специфичности
     """
+    __slots__ = ()
+
+
+class LazyAttachment(Attachment):
+    __slots__ = ("kind", "file_size", "_attachment")
+
+    def __init__(self, id: int, kind: AttachmentKind, file_size: Optional[int],
+                 factory: Callable[[], Awaitable[Attachment]],
+                 source: object = None, caller: object = None):
+        """
+        Вложение, которое преобразуется полностью только при первом await.
+        :param id: ID объекта
+        :param kind: Тип вложения
+        :param file_size: Размер файла, если известен
+        :param factory: Функция без аргументов, возвращающая корутину с готовым вложением
+        :param source: Если преобразовано из другого типа данных, то указывается он
+        :param caller: Интерфейс, создавший этот объект
+        """
+        super().__init__(id, source, caller)
+        self.kind = kind
+        self.file_size = file_size
+        self._attachment = Lazy(factory, key=(kind, id))
+
+    @property
+    def resolved(self) -> bool:
+        return self._attachment.resolved
+
+    async def resolve(self) -> Attachment:
+        return await self._attachment
+
+    def __await__(self):
+        return self.resolve().__await__()
 
 
 class Media(Attachment, ABC):
+    __slots__ = ("file_size", "file_name")
+    source_required = True
+
     def __init__(self, id: int, file_name: str, file_size: int, source: object = None, caller: object = None):
         """
         Базовый класс для всех медиа.
@@ -99,11 +298,44 @@ class Media(Attachment, ABC):
     async def get(self):
         pass
 
+    async def iter_chunks(self, chunk_size: int = CHUNK_SIZE, offset: int = 0) -> AsyncIterator[bytes]:
+        """
+        Отдаёт содержимое файла частями. Интерфейсы переопределяют его для потоковой загрузки,
+        по умолчанию файл целиком получается через get().
+        :param chunk_size: Размер части в байтах
+        :param offset: С какого байта начинать
+        """
+        data = await self.get()
+        if data:
+            view = memoryview(data)
+            for start in range(offset, len(data), chunk_size):
+                yield bytes(view[start:start + chunk_size])
+
+    async def save_to(self, path: str, chunk_size: int = CHUNK_SIZE) -> int:
+        """
+        Сохраняет файл на диск по частям, запись идёт в потоке, чтобы не блокировать цикл событий.
+        :param path: Путь к файлу
+        :param chunk_size: Размер части в байтах
+        :return: Количество записанных байт
+        """
+        loop = asyncio.get_running_loop()
+        written = 0
+        file = await loop.run_in_executor(None, open, path, "wb")
+        try:
+            async for chunk in self.iter_chunks(chunk_size):
+                await loop.run_in_executor(None, file.write, chunk)
+                written += len(chunk)
+        finally:
+            await loop.run_in_executor(None, file.close)
+        return written
+
     # def __str__(self):
     #     return f"{self.__class__.__name__} {format_bytes(self.file_size)}"
 
 
 class User(Entity, ABC):
+    __slots__ = ("platform", "first_name", "last_name", "username", "is_bot")
+
     def __init__(self, id: int, platform: str, first_name: str, last_name: str, username: str, is_bot: bool,
                  source: object = None, caller: object = None):
         """
@@ -126,6 +358,8 @@ class User(Entity, ABC):
 
 
 class Chat(Entity, ABC):
+    __slots__ = ("platform", "type", "title", "members")
+
     def __init__(self, id: int, platform: str, type: ChatType, title: str, members: list[User],
                  source: object = None, caller: object = None):
         """
@@ -146,6 +380,8 @@ class Chat(Entity, ABC):
 
 
 class Message(Entity, ABC):
+    __slots__ = ("from_user", "chat", "date", "text", "attachments")
+
     def __init__(self, id: int, from_user: User, chat: Chat, date: datetime.datetime, text: str,
                  attachments: list[Attachment],
                  source: object = None, caller: object = None):
@@ -167,6 +403,17 @@ class Message(Entity, ABC):
         self.text = text
         self.attachments = attachments
 
+    async def get_attachments(self) -> list[Attachment]:
+        """
+        Возвращает вложения, дожидаясь преобразования отложенных (LazyAttachment).
+        """
+        if any(isinstance(attachment, LazyAttachment) for attachment in self.attachments):
+            self.attachments = list(await asyncio.gather(*(
+                attachment.resolve() if isinstance(attachment, LazyAttachment) else _ready(attachment)
+                for attachment in self.attachments
+            )))
+        return self.attachments
+
     @abstractmethod
     async def reply(self, text: str, attachments: list[Attachment] = None):
         pass
@@ -181,6 +428,8 @@ class Message(Entity, ABC):
 
 
 class Sticker(Media, ABC):
+    __slots__ = ("alt", "sticker_set")
+
     def __init__(self, id: int, file_name: str, file_size: int, alt: str, sticker_set: object,
                  source: object = None, caller: object = None):
         """
@@ -189,7 +438,7 @@ class Sticker(Media, ABC):
         :param file_name: Имя файла
         :param file_size: Размер файла
         :param alt: Смайл, сходный с содержанием со стикером
-        :param sticker_set: Набор стикеров данного стикера
+        :param sticker_set: Набор стикеров данного стикера, обычно Lazy - получается через await
         :param source: Если преобразовано из другого типа данных, то указывается он
         :param caller: Интерфейс, создавший этот объект
         """
@@ -199,6 +448,8 @@ class Sticker(Media, ABC):
 
 
 class AnimatedSticker(Sticker, ABC):
+    __slots__ = ("duration",)
+
     def __init__(self, id: int, file_name: str, file_size: int, duration: int | float, alt: str, sticker_set: object,
                  source: object = None, caller: object = None):
         """
@@ -208,7 +459,7 @@ class AnimatedSticker(Sticker, ABC):
         :param file_size: Размер файла
         :param duration: Длина анимации
         :param alt: Смайл, сходный с содержанием со стикером
-        :param sticker_set: Набор стикеров данного стикера
+        :param sticker_set: Набор стикеров данного стикера, обычно Lazy - получается через await
         :param source: Если преобразовано из другого типа данных, то указывается он
         :param caller: Интерфейс, создавший этот объект
         """
@@ -217,6 +468,8 @@ class AnimatedSticker(Sticker, ABC):
 
 
 class StickerSet(Attachment, ABC):
+    __slots__ = ("title", "count_stickers")
+
     def __init__(self, id: int, title: str, count_stickers: int,
                  source: object = None, caller: object = None):
         """
@@ -241,6 +494,8 @@ class StickerSet(Attachment, ABC):
 
 
 class Photo(Media, ABC):
+    __slots__ = ()
+
     def __init__(self, id: int, file_name: str, file_size: int, source: object = None, caller: object = None):
         """
         Фотография.
@@ -254,6 +509,8 @@ class Photo(Media, ABC):
 
 
 class Video(Media, ABC):
+    __slots__ = ("duration",)
+
     def __init__(self, id: int, file_name: str, file_size: int, duration: int | float, source: object = None,
                  caller: object = None):
         """
@@ -270,6 +527,8 @@ class Video(Media, ABC):
 
 
 class Audio(Media, ABC):
+    __slots__ = ("duration",)
+
     def __init__(self, id: int, file_name: str, file_size: int, duration: int | float, source: object = None,
                  caller: object = None):
         """
@@ -286,6 +545,8 @@ class Audio(Media, ABC):
 
 
 class Document(Media, ABC):
+    __slots__ = ()
+
     def __init__(self, id: int, file_name: str, file_size: int, source: object = None, caller: object = None):
         """
         Документ или любой файл.
@@ -299,6 +560,8 @@ class Document(Media, ABC):
 
 
 class PollAnswer(Entity, ABC):
+    __slots__ = ("text", "voters", "correct")
+
     def __init__(self, id: int, text: str, voters: int | list[User], correct: Optional[bool],
                  source: object = None, caller: object = None):
         """
@@ -317,6 +580,9 @@ class PollAnswer(Entity, ABC):
 
 
 class Poll(Attachment, ABC):
+    __slots__ = ("question", "answers", "voters", "public_votes", "multiple_choice", "quiz", "solution", "closed",
+                 "close_period", "close_date")
+
     def __init__(self, id: int, question: str, answers: list[PollAnswer], voters: int | list[User],
                  public_votes: bool, multiple_choice: bool, quiz: bool, solution: Optional[PollAnswer], closed: bool,
                  close_period: Optional[int], close_date: Optional[datetime.datetime],
@@ -351,6 +617,8 @@ class Poll(Attachment, ABC):
 
 
 class GeoPoint(Attachment, ABC):
+    __slots__ = ("latitude", "longitude", "accuracy")
+
     def __init__(self, id: int, latitude: float, longitude: float, accuracy: Optional[float] = None,
                  source: object = None, caller: object = None):
         """
@@ -369,6 +637,8 @@ class GeoPoint(Attachment, ABC):
 
 
 class Venue(Attachment, ABC):
+    __slots__ = ("geo", "title", "address")
+
     def __init__(self, id: int, geo: GeoPoint, title: str, address: str,
                  source: object = None, caller: object = None):
         """
@@ -387,6 +657,8 @@ class Venue(Attachment, ABC):
 
 
 class Contact(Attachment, ABC):
+    __slots__ = ("phone_number", "first_name", "last_name", "username")
+
     def __init__(self, id: int, phone_number: str, first_name: str, last_name: str, username: str,
                  source: object = None, caller: object = None):
         """
@@ -1,12 +1,16 @@
+import asyncio
+import hashlib
+import logging
 import os
-from typing import Any, Optional
+from typing import Any, Iterable, Optional
 
 import telethon
 from telethon import TelegramClient
+from telethon.errors import FloodWaitError, SlowModeWaitError
 from telethon.events import NewMessage
 
 from .types import *
-from ..base import Interface, BaseInterface
+from ..base import Interface, BaseInterface, TTLCache, tracer
 from ..base import types as base
 
 API_ID = os.getenv("API_ID")
@@ -14,6 +18,15 @@ API_HASH = os.getenv("API_HASH")
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 
 PLATFORM = "Telegram"
+STICKER_SET_CACHE_SIZE = 256
+RESOLVE_CONCURRENCY = 8
+UPLOAD_CACHE_SIZE = 1024
+# Загруженный файл (InputFile) действует меньше суток
+UPLOAD_CACHE_TTL = 12 * 3600
+
+# Объекты, которые Telegram принимает как файл без повторной загрузки
+FILE_REFERENCES = (telethon.types.Document, telethon.types.Photo, telethon.types.InputFile,
+                   telethon.types.InputFileBig)
 
 
 def encode(word: str, id: int, encoding="utf-8") -> int:
@@ -29,67 +42,245 @@ def decode(n: int, encoding="utf-8") -> tuple[str, int]:
 
 
 class TelegramInterface(Interface):
+    platform = PLATFORM
+    send_rate = 30.0
+    chat_send_rate = 1.0
+
     def __init__(self, base_interface: BaseInterface,
                  api_id: int = API_ID,
                  api_hash: str = API_HASH,
                  bot_token: str = BOT_TOKEN,
-                 session_name: str = "main"):
-        super().__init__(base_interface)
+                 session_name: str = "main",
+                 client: TelegramClient = None,
+                 lazy_attachments: bool = True,
+                 keep_source: bool = True):
+        """
+        :param client: Готовый клиент вместо создания нового (например, benchmarks.fake_client.FakeTelegramClient)
+        :param lazy_attachments: Преобразовывать вложения только по запросу обработчика
+        :param keep_source: Хранить ли в сущностях исходные TL-объекты
+        """
+        super().__init__(base_interface, lazy_attachments=lazy_attachments, keep_source=keep_source)
         self.api_id = api_id
         self.api_hash = api_hash
         self.bot_token = bot_token
-        self.client = TelegramClient(
+        # Авторизация - в connect, чтобы не блокировать запуск остальных интерфейсов
+        self.client = client or TelegramClient(
             session_name,
             self.api_id,
             self.api_hash,
-        ).start(bot_token=self.bot_token)
+        )
         self.base_interface = base_interface
         self.buffer: Any = None
+        # Lazy наборов стикеров по (id, access_hash); GetStickerSetRequest тяжёлый - тянет все документы набора
+        self.sticker_set_cache = TTLCache(maxsize=STICKER_SET_CACHE_SIZE, ttl=None)
+        # sha256 содержимого -> Lazy с загруженным файлом, а после отправки - с документом/фото из сообщения
+        self.upload_cache = TTLCache(maxsize=UPLOAD_CACHE_SIZE, ttl=UPLOAD_CACHE_TTL)
 
         # Добавляем обработчик сообщений
         self.client.add_event_handler(self._handle_message, NewMessage())
 
     async def _handle_message(self, event: NewMessage.Event):
-        # Преобразуем сообщение в объект Entity
-        entity: TelegramMessage = await self.transform(event.message)  # type: ignore
+        with tracer.span("receive"):
+            # Преобразуем сообщение в объект Entity
+            entity: TelegramMessage = await self.transform(event.message)  # type: ignore
 
-        # Вызываем обработчик сообщения из base_interface
-        await self.base_interface.message_handler(entity)
+            # Передаём сообщение в очередь base_interface
+            await self.base_interface.dispatch(entity)
 
     async def transform(self, tl: telethon.types.TLObject) -> base.Entity:
-        if isinstance(tl, telethon.types.PeerUser) or isinstance(tl, telethon.types.User):
-            return await TelegramUser.from_tl(tl, caller=self)
+        converter = TRANSFORMERS.lookup(tl)
+        if converter is None:
+            raise ValueError(f"Unsupported TLObject type: {type(tl)}")
+        with tracer.span("transform", type(tl).__name__):
+            return await converter(tl, caller=self)
 
-        elif isinstance(tl, telethon.types.Message):
-            return await TelegramMessage.from_tl(tl, caller=self)
+    async def transform_many(self, tl_objects: Iterable[telethon.types.TLObject]) -> list[base.Entity]:
+        tl_objects = list(tl_objects)
 
-        elif isinstance(tl, telethon.types.Document):
-            return await TelegramDocument.from_tl(tl, caller=self)
+        peer_ids = []
+        for tl in tl_objects:
+            if isinstance(tl, telethon.types.Message):
+                # Пользователи, пришедшие вместе с ответом API, попадают в кэш без запросов
+                sender = getattr(tl, "sender", None)
+                if isinstance(sender, telethon.types.User):
+                    self.entity_cache.set(sender.id, sender)
+                tl = tl.peer_id
+            if isinstance(tl, telethon.types.PeerUser):
+                peer_ids.append(tl.user_id)
 
-        elif isinstance(tl, telethon.types.InputStickerSetID):
-            return await TelegramStickerSet.from_tl(tl, caller=self)
+        # Остальных получаем одним запросом, после чего преобразование идёт без обращений к сети
+        await self.resolve_entities(peer_ids)
+        return [await self.transform(tl) for tl in tl_objects]
 
-        elif isinstance(tl, telethon.types.GeoPoint):
-            return await TelegramGeoPoint.from_tl(tl, caller=self)
+    def conversion_stats(self) -> dict[str, dict]:
+        return {registry.name: registry.stats() for registry in (TRANSFORMERS, ATTACHMENTS, DOCUMENT_ATTRIBUTES)}
 
-        else:
-            raise ValueError(f"Unsupported TLObject type: {type(tl)}")
+    async def resolve_entity(self, id: int) -> telethon.types.TLObject:
+        """
+        Возвращает TL-объект пользователя или чата, по возможности из кэша.
+        :param id: ID пользователя или чата
+        """
+        tl_object = self.entity_cache.get(id)
+        if tl_object is None:
+            tl_object = await self.client.get_entity(id)
+            self.entity_cache.set(id, tl_object)
+        return tl_object
+
+    async def resolve_entities(self, ids: Iterable[int]) -> dict[int, telethon.types.TLObject]:
+        """
+        Возвращает TL-объекты сразу для нескольких ID: из кэша, а недостающие одним запросом.
+        :param ids: ID пользователей или чатов, повторы допускаются
+        """
+        result = {}
+        missing = []
+        for id in dict.fromkeys(ids):
+            tl_object = self.entity_cache.get(id)
+            if tl_object is None:
+                missing.append(id)
+            else:
+                result[id] = tl_object
+
+        if not missing:
+            return result
+
+        try:
+            # Telethon собирает пользователей из списка в один GetUsersRequest
+            tl_objects = await self.client.get_entity(missing)
+            for id, tl_object in zip(missing, tl_objects):
+                self.entity_cache.set(id, tl_object)
+                result[id] = tl_object
+        except Exception as e:
+            logging.warning("Пакетное получение сущностей не удалось, запрашиваем по одной: %s", e)
+            semaphore = asyncio.Semaphore(RESOLVE_CONCURRENCY)
+
+            async def resolve(id: int):
+                async with semaphore:
+                    try:
+                        result[id] = await self.resolve_entity(id)
+                    except Exception as e:
+                        logging.warning("Не удалось получить сущность %s: %s", id, e)
+
+            await asyncio.gather(*(resolve(id) for id in missing))
+
+        return result
+
+    def invalidate_entity(self, id: int) -> bool:
+        return self.entity_cache.invalidate(id)
 
     async def get_entity(self, n: int | TelegramMessage) -> Optional[base.Entity]:
         tl_object = None
         if isinstance(n, int):
-            tl_object = await self.client.get_entity(n)
+            tl_object = await self.resolve_entity(n)
         elif isinstance(n, TelegramMessage):
             tl_object = await self.client.get_messages(n.from_user.id, ids=n.id)
 
         if tl_object:
             return await self.transform(tl_object)
 
-    async def send_message(self, id: int, text: str, attachments: list[base.Media] = None) -> base.Entity:
-        tl_object = await self.client.send_message(id, text)
+    async def get_messages(self, chat: int, limit: int = 100, offset: int = 0) -> list[TelegramMessage]:
+        tl_objects = await self.client.get_messages(chat, limit=limit, add_offset=offset)
+        # Служебные сообщения (вход в чат и т.п.) не преобразуются
+        return await self.transform_many(tl for tl in tl_objects if isinstance(tl, telethon.types.Message))
+
+    def retry_after(self, error: Exception) -> Optional[float]:
+        if isinstance(error, (FloodWaitError, SlowModeWaitError)):
+            return error.seconds
+        return None
+
+    def chat_limited(self, error: Exception) -> bool:
+        # FloodWait действует на весь аккаунт, медленный режим - на один чат
+        return isinstance(error, SlowModeWaitError)
+
+    async def input_file(self, media: base.Attachment) -> tuple[telethon.types.TLObject, Optional[str]]:
+        """
+        Файл для отправки. Медиа этого же бота пересылаются по ссылке, остальные загружаются
+        один раз на одинаковое содержимое.
+        :param media: Вложение, в том числе ещё не преобразованное
+        :return: Файл и sha256 содержимого (None, если файл отправляется по ссылке)
+        """
+        if isinstance(media, base.LazyAttachment):
+            media = await media
+        if not isinstance(media, base.Media):
+            raise ValueError(f"Неподдерживаемое вложение: {type(media).__name__}")
+        if media.caller is self and isinstance(media.source, FILE_REFERENCES):
+            return media.source, None
+
+        data = await media.get()
+        if not data:
+            raise ValueError(f"Не удалось получить содержимое {media.file_name}")
+        digest = hashlib.sha256(data).hexdigest()
+        uploaded = self.upload_cache.get(digest)
+        if uploaded is None:
+            # Одновременные отправки одного файла (рассылка) ждут одну загрузку
+            uploaded = base.Lazy(lambda: self.client.upload_file(data, file_name=media.file_name), key=digest)
+            self.upload_cache.set(digest, uploaded)
+        try:
+            return await uploaded, digest
+        except Exception:
+            self.upload_cache.invalidate(digest)
+            raise
+
+    async def input_files(self, attachments: Optional[list[base.Attachment]]) -> tuple[list, list[Optional[str]]]:
+        if not attachments:
+            return [], []
+        files = await asyncio.gather(*(self.input_file(media) for media in attachments))
+        return [file for file, _ in files], [digest for _, digest in files]
+
+    def remember_uploads(self, tl_objects: Any, digests: list[Optional[str]]):
+        """
+        Запоминает медиа отправленных сообщений: дальше тот же файл отправляется по ссылке на них.
+        :param tl_objects: Сообщение или альбом (список сообщений) в порядке файлов
+        :param digests: sha256 файлов из input_files
+        """
+        if not isinstance(tl_objects, list):
+            tl_objects = [tl_objects]
+        for tl, digest in zip(tl_objects, digests):
+            reference = getattr(tl, "document", None) or getattr(tl, "photo", None)
+            if digest and reference:
+                self.upload_cache.set(digest, base.Lazy.resolved_with(reference, key=digest))
+
+    @staticmethod
+    def file_argument(files: list) -> Any:
+        # Один файл - обычное сообщение, несколько - альбом
+        return files[0] if len(files) == 1 else files
+
+    async def prepare_attachments(self, attachments: list[base.Attachment]) -> list[base.Media]:
+        prepared = []
+        for media, (file, _) in zip(attachments, await asyncio.gather(*map(self.input_file, attachments))):
+            if isinstance(media, base.LazyAttachment):
+                media = await media
+            prepared.append(TelegramDocument(id=media.id, file_size=media.file_size, file_name=media.file_name,
+                                             source=file, caller=self))
+        return prepared
+
+    async def send(self, id: int, text: str, attachments: list[base.Attachment] = None) -> Any:
+        files, digests = await self.input_files(attachments)
+        if files:
+            send = lambda: self.client.send_file(id, self.file_argument(files), caption=text)
+        else:
+            send = lambda: self.client.send_message(id, text)
+        tl_object = await self.sender.submit(id, send)
+        self.remember_uploads(tl_object, digests)
+        return tl_object
+
+    async def send_message(self, id: int, text: str, attachments: list[base.Attachment] = None) -> base.Entity:
+        tl_object = await self.send(id, text, attachments)
+        # Для альбома возвращается первое сообщение
+        if isinstance(tl_object, list):
+            tl_object = tl_object[0]
         return await self.transform(tl_object)
 
+    async def connect(self):
+        await self.client.start(bot_token=self.bot_token)
+
     async def start(self):
-        print("Клиент запущен.")
+        logging.info("Клиент %s запущен.", PLATFORM)
         await self.send_message(1667209703, "Бот запущен.")
         await self.client.run_until_disconnected()
+
+    async def pause(self):
+        self.client.remove_event_handler(self._handle_message, NewMessage)
+
+    async def stop(self):
+        await super().stop()
+        await self.client.disconnect()
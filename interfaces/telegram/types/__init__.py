@@ -15,4 +15,8 @@ from .t import (
     TelegramVenue,
     TelegramContact,
     TelegramMessage,
+    TRANSFORMERS,
+    ATTACHMENTS,
+    ATTACHMENT_INFO,
+    DOCUMENT_ATTRIBUTES,
 )
@@ -1,19 +1,27 @@
 import datetime
 import logging
-from typing import Any, Optional
+from typing import AsyncIterator, Optional
 
 import telethon.types
 from telethon.tl.functions.messages import GetStickerSetRequest
 from telethon.tl.patched import Message
 from telethon.types import TLObject, DocumentAttributeSticker
 
-from ...base import Interface
+from ...base import Interface, ConversionRegistry, Priority, tracer
 from ...base import types
 
 PLATFORM = "Telegram"
 
+# Таблицы преобразования TL-объектов, заполняются ниже рядом с конвертерами
+TRANSFORMERS = ConversionRegistry("transform")
+ATTACHMENTS = ConversionRegistry("attachment")
+ATTACHMENT_INFO = ConversionRegistry("attachment_info")
+DOCUMENT_ATTRIBUTES = ConversionRegistry("document_attribute")
+
 
 class TelegramUser(types.User):
+    __slots__ = ()
+
     def __init__(self, id: int, first_name: str, last_name: str, username: str, is_bot: bool, platform=PLATFORM,
                  source: object = None, caller: Interface = None):
         super().__init__(id=id, platform=platform, first_name=first_name, last_name=last_name, username=username,
@@ -22,7 +30,9 @@ class TelegramUser(types.User):
     @classmethod
     async def from_tl(cls, tl: telethon.types.PeerUser | telethon.types.User, caller: Interface):
         if isinstance(tl, telethon.types.PeerUser):
-            tl: telethon.types.User = await caller.client.get_entity(tl.user_id)
+            tl: telethon.types.User = await caller.resolve_entity(tl.user_id)
+        else:
+            caller.entity_cache.set(tl.id, tl)
         return cls(
             id=tl.id,
             first_name=tl.first_name or '',
@@ -35,6 +45,8 @@ class TelegramUser(types.User):
 
 
 class TelegramChat(types.Chat):
+    __slots__ = ()
+
     def __init__(self, id: int, type: types.ChatType, title: str, members: list[types.User], platform=PLATFORM,
                  source: object = None, caller: Interface = None):
         super().__init__(id=id, platform=platform, type=type, title=title, members=members,
@@ -42,6 +54,8 @@ class TelegramChat(types.Chat):
 
 
 class TelegramMedia(types.Media):
+    __slots__ = ()
+
     def __init__(self, id: int, file_name: str, file_size: int,
                  source: object = None, caller: Interface = None):
         super().__init__(id=id, file_name=file_name, file_size=file_size, source=source, caller=caller)
@@ -52,13 +66,31 @@ class TelegramMedia(types.Media):
             return await self.get()
 
         elif isinstance(self.source, TLObject) and self.caller:
-            return await self.caller.client.download_media(self.source, file=bytes)
+            store = self.caller.base_interface.media_store
+            key = store.key(self)
+            data = await store.get_bytes(key) if key else None
+            if data is None:
+                data = await self.caller.client.download_media(self.source, file=bytes)
+                if key and data:
+                    await store.put_bytes(key, data)
+            return data
 
         elif isinstance(self.source, bytes):
             return self.source
 
+    async def iter_chunks(self, chunk_size: int = types.CHUNK_SIZE, offset: int = 0) -> AsyncIterator[bytes]:
+        if isinstance(self.source, TLObject) and self.caller:
+            async for chunk in self.caller.client.iter_download(self.source, offset=offset, request_size=chunk_size,
+                                                                 file_size=self.file_size):
+                yield chunk
+        else:
+            async for chunk in super().iter_chunks(chunk_size, offset):
+                yield chunk
+
 
 class TelegramMessage(types.Message):
+    __slots__ = ()
+
     def __init__(self, id: int, from_user: TelegramUser, chat: TelegramChat, date: datetime.datetime, text: str,
                  attachments: list[types.Attachment],
                  source: object = None, caller: Interface = None):
@@ -69,9 +101,13 @@ class TelegramMessage(types.Message):
     async def from_tl(cls, tl: telethon.types.Message, caller: Interface):
         attachments = []
         if tl.media:
-            attachments.append(await process_attachment(tl.media, caller=caller))
+            if caller.lazy_attachments:
+                attachments.append(lazy_attachment(tl.media, caller=caller))
+            else:
+                attachments.append(await process_attachment(tl.media, caller=caller))
 
-        user = await TelegramUser.from_tl(tl.peer_id, caller=caller)
+        with tracer.span("from_tl", "User"):
+            user = await TelegramUser.from_tl(tl.peer_id, caller=caller)
         chat = TelegramChat(
             id=tl.peer_id.user_id,
             type=types.ChatType.PRIVATE,
@@ -91,37 +127,57 @@ class TelegramMessage(types.Message):
             caller=caller
         )
 
+    # Отправка идёт через очередь интерфейса (caller.sender).
+    # Без source (keep_source=False) отправляем по ID чата и сообщения
+    # Вложения загружаются один раз на одинаковое содержимое, см. TelegramInterface.input_file
     async def reply(self, text: str, attachments: list[types.Attachment] = None):
-        if not self.source and self.caller:
-            self.source = self.caller.get_entity(self.id)
-            await self.reply(text, attachments)
+        files, digests = await self.caller.input_files(attachments)
+        client = self.caller.client
+        if files:
+            send = lambda: client.send_file(self.chat.id, self.caller.file_argument(files), caption=text,
+                                            reply_to=self.id)
         elif isinstance(self.source, Message):
-            await self.source.reply(text)
+            send = lambda: self.source.reply(text)
+        else:
+            send = lambda: client.send_message(self.chat.id, text, reply_to=self.id)
+        self.caller.remember_uploads(await self.caller.sender.submit(self.chat.id, send, priority=Priority.REPLY),
+                                     digests)
 
     async def answer(self, text: str, attachments: list[types.Attachment] = None):
-        if not self.source and self.caller:
-            self.source = self.caller.get_entity(self.id)
-            await self.answer(text, attachments)
+        files, digests = await self.caller.input_files(attachments)
+        client = self.caller.client
+        if files:
+            send = lambda: client.send_file(self.chat.id, self.caller.file_argument(files), caption=text)
         elif isinstance(self.source, Message):
-            await self.source.respond(text)
+            send = lambda: self.source.respond(text)
+        else:
+            send = lambda: client.send_message(self.chat.id, text)
+        self.caller.remember_uploads(await self.caller.sender.submit(self.chat.id, send, priority=Priority.REPLY),
+                                     digests)
 
     async def edit(self, text: str, attachments: list[types.Attachment] = None):
-        if not self.source and self.caller:
-            self.source = self.caller.get_entity(self.id)
-            await self.reply(text, attachments)
-        elif isinstance(self.source, Message):
-            await self.source.edit(text)
+        if isinstance(self.source, Message):
+            send = lambda: self.source.edit(text)
+        else:
+            send = lambda: self.caller.client.edit_message(self.chat.id, self.id, text)
+        # Несколько правок подряд одного сообщения сливаются в последнюю
+        await self.caller.sender.submit(self.chat.id, send, priority=Priority.REPLY,
+                                        coalesce_key=("edit", self.chat.id, self.id))
 
 
 class TelegramSticker(types.Sticker, TelegramMedia):
-    def __init__(self, id: int, file_size: int, alt: str, sticker_set: Any, file_name: str = "sticker.webp",
+    __slots__ = ()
+
+    def __init__(self, id: int, file_size: int, alt: str, sticker_set: types.Lazy, file_name: str = "sticker.webp",
                  source: object = None, caller: Interface = None):
         super().__init__(id=id, file_size=file_size, file_name=file_name, alt=alt, sticker_set=sticker_set,
                          source=source, caller=caller)
 
 
 class TelegramAnimatedSticker(types.AnimatedSticker, TelegramSticker):
-    def __init__(self, id: int, file_size: int, duration: int | float, alt: str, sticker_set: Any,
+    __slots__ = ()
+
+    def __init__(self, id: int, file_size: int, duration: int | float, alt: str, sticker_set: types.Lazy,
                  file_name: str = "sticker.webm",
                  source: object = None, caller: Interface = None):
         super().__init__(id=id, file_name=file_name, file_size=file_size, duration=duration,
@@ -129,12 +185,18 @@ class TelegramAnimatedSticker(types.AnimatedSticker, TelegramSticker):
 
 
 class TelegramStickerSet(types.StickerSet):
+    __slots__ = ()
+
     def __init__(self, id: int, title: str, count_stickers: int,
                  source: object = None, caller: Interface = None):
         super().__init__(id=id, title=title, count_stickers=count_stickers, source=source, caller=caller)
 
     @classmethod
     async def from_tl(cls, tl: telethon.types.InputStickerSetID, caller: Interface):
+        return await cls.lazy(tl, caller=caller)
+
+    @classmethod
+    async def _request(cls, tl: telethon.types.InputStickerSetID, caller: Interface):
         sticker_set: telethon.types.messages.StickerSet = await caller.client(GetStickerSetRequest(tl, 0))
         return TelegramStickerSet(
             id=sticker_set.set.id,
@@ -144,6 +206,19 @@ class TelegramStickerSet(types.StickerSet):
             caller=caller
         )
 
+    @classmethod
+    def lazy(cls, tl: telethon.types.InputStickerSetID, caller: Interface) -> types.Lazy:
+        """
+        Возвращает набор стикеров, который будет запрошен только при первом await.
+        Lazy хранится в кэше ещё до запроса, так что одновременные сообщения с одним набором ждут один запрос.
+        """
+        key = (tl.id, tl.access_hash)
+        lazy = caller.sticker_set_cache.get(key)
+        if lazy is None:
+            lazy = types.Lazy(lambda: cls._request(tl, caller=caller), key=key)
+            caller.sticker_set_cache.set(key, lazy)
+        return lazy
+
     async def get_sticker_by_index(self, index: int) -> TelegramSticker:
         return (await self.get_all_stickers())[index]
 
@@ -163,13 +238,15 @@ class TelegramStickerSet(types.StickerSet):
 
 
 class TelegramPhoto(types.Photo, TelegramMedia):
+    __slots__ = ()
+
     def __init__(self, id: int, file_size: int, file_name: str = "image.jpg",
                  source: object = None, caller: Interface = None):
         super().__init__(id=id, file_size=file_size, file_name=file_name, source=source, caller=caller)
 
     @classmethod
     async def from_tl(cls, tl: telethon.types.Photo, caller: Interface):
-        size: int = max(tl.sizes[-1].sizes)
+        size: int = photo_size(tl)
         return TelegramPhoto(
             id=tl.id,
             file_size=size,
@@ -179,6 +256,8 @@ class TelegramPhoto(types.Photo, TelegramMedia):
 
 
 class TelegramVideo(types.Video, TelegramMedia):
+    __slots__ = ()
+
     def __init__(self, id: int, file_size: int, duration: int | float, file_name: str = "video.mp4",
                  source: object = None, caller: Interface = None):
         super().__init__(id=id, file_name=file_name, file_size=file_size, duration=duration,
@@ -187,6 +266,8 @@ class TelegramVideo(types.Video, TelegramMedia):
 
 
 class TelegramAudio(types.Audio, TelegramMedia):
+    __slots__ = ()
+
     def __init__(self, id: int, file_size: int, duration: int | float, file_name: Optional[str] = "audio.ogg",
                  source: object = None, caller: Interface = None):
         super().__init__(id=id, file_name=file_name, file_size=file_size, duration=duration,
@@ -194,6 +275,8 @@ class TelegramAudio(types.Audio, TelegramMedia):
 
 
 class TelegramDocument(types.Document, TelegramMedia):
+    __slots__ = ()
+
     def __init__(self, id: int, file_size: int, file_name: str,
                  source: object = None, caller: Interface = None):
         super().__init__(id=id, file_name=file_name, file_size=file_size, source=source, caller=caller)
@@ -212,28 +295,21 @@ class TelegramDocument(types.Document, TelegramMedia):
             "caller": caller,
         }
 
-        sticker_attributes = audio_attributes = image_attributes = video_attributes = file_name = None
-        for attr in tl.attributes:
-            if isinstance(attr, telethon.types.DocumentAttributeFilename):
-                file_name = attr.file_name
-            elif isinstance(attr, telethon.types.DocumentAttributeSticker):
-                sticker_attributes = attr
-            elif isinstance(attr, telethon.types.DocumentAttributeAudio):
-                audio_attributes = attr
-            elif isinstance(attr, telethon.types.DocumentAttributeImageSize):
-                image_attributes = attr
-            elif isinstance(attr, telethon.types.DocumentAttributeVideo):
-                video_attributes = attr
-
-        if file_name:
-            kwargs['file_name'] = file_name
+        attributes = document_attributes(tl)
+        sticker_attributes = attributes.get("sticker")
+        audio_attributes = attributes.get("audio")
+        image_attributes = attributes.get("image")
+        video_attributes = attributes.get("video")
+
+        if "file_name" in attributes and attributes["file_name"].file_name:
+            kwargs['file_name'] = attributes["file_name"].file_name
 
         if sticker_attributes:
             # Обработка стикеров
             if isinstance(sticker_attributes.stickerset, telethon.types.InputStickerSetID):
-                sticker_set = await TelegramStickerSet.from_tl(sticker_attributes.stickerset, caller=caller)
+                sticker_set = TelegramStickerSet.lazy(sticker_attributes.stickerset, caller=caller)
             else:
-                sticker_set = sticker_attributes.stickerset
+                sticker_set = types.Lazy.resolved_with(sticker_attributes.stickerset)
 
             kwargs['sticker_set'] = sticker_set
             kwargs['alt'] = sticker_attributes.alt
@@ -256,12 +332,16 @@ class TelegramDocument(types.Document, TelegramMedia):
 
 
 class TelegramPollAnswer(types.PollAnswer):
+    __slots__ = ()
+
     def __init__(self, id: int, text: str, voters: int | list[types.User], correct: Optional[bool],
                  source: object = None, caller: Interface = None):
         super().__init__(id=id, text=text, voters=voters, correct=correct, source=source, caller=caller)
 
 
 class TelegramPoll(types.Poll):
+    __slots__ = ()
+
     def __init__(self, id: int, question: str, answers: list[TelegramPollAnswer], voters: int | list[types.User],
                  public_votes: bool, multiple_choice: bool, quiz: bool, solution: Optional[str], closed: bool,
                  close_period: Optional[int], close_date: Optional[datetime.datetime],
@@ -284,9 +364,11 @@ class TelegramPoll(types.Poll):
             ))
 
         if tl.results.recent_voters:
-            voters = []
-            for user in tl.results.recent_voters:
-                voters.append(await TelegramUser.from_tl(user, caller=caller))
+            # В новых слоях recent_voters - список Peer, в старых - список ID
+            ids = [voter.user_id if isinstance(voter, telethon.types.PeerUser) else voter
+                   for voter in tl.results.recent_voters if isinstance(voter, (int, telethon.types.PeerUser))]
+            resolved = await caller.resolve_entities(ids)
+            voters = [await TelegramUser.from_tl(resolved[id], caller=caller) for id in ids if id in resolved]
         else:
             voters = tl.results.total_voters
 
@@ -310,6 +392,8 @@ class TelegramPoll(types.Poll):
 
 
 class TelegramGeoPoint(types.GeoPoint):
+    __slots__ = ()
+
     def __init__(self, id: int, latitude: float, longitude: float, accuracy: Optional[float] = None,
                  source: object = None, caller: Interface = None):
         super().__init__(id=id, latitude=latitude, longitude=longitude, accuracy=accuracy,
@@ -328,6 +412,8 @@ class TelegramGeoPoint(types.GeoPoint):
 
 
 class TelegramVenue(types.Venue):
+    __slots__ = ()
+
     def __init__(self, id: int | str, geo: TelegramGeoPoint, title: str, address: str,
                  source: object = None, caller: Interface = None):
         if isinstance(id, str):
@@ -350,6 +436,8 @@ class TelegramVenue(types.Venue):
 
 
 class TelegramContact(types.Contact):
+    __slots__ = ()
+
     def __init__(self, id: int, phone_number: str, first_name: str, last_name: str, username: str,
                  source: object = None, caller: Interface = None):
         super().__init__(id=id, phone_number=phone_number, first_name=first_name, last_name=last_name,
@@ -368,29 +456,112 @@ class TelegramContact(types.Contact):
         )
 
 
-async def process_attachment(tl: TLObject, caller: Interface) -> types.Attachment:
-    if isinstance(tl, telethon.types.MessageMediaPhoto):
-        return await TelegramPhoto.from_tl(tl.photo, caller=caller)
+TRANSFORMERS.register(telethon.types.PeerUser, telethon.types.User)(TelegramUser.from_tl)
+TRANSFORMERS.register(telethon.types.Message)(TelegramMessage.from_tl)
+TRANSFORMERS.register(telethon.types.Document)(TelegramDocument.from_tl)
+TRANSFORMERS.register(telethon.types.InputStickerSetID)(TelegramStickerSet.from_tl)
+TRANSFORMERS.register(telethon.types.GeoPoint)(TelegramGeoPoint.from_tl)
 
-    elif isinstance(tl, telethon.types.MessageMediaPoll):
-        return await TelegramPoll.from_tl(tl, caller=caller)
+DOCUMENT_ATTRIBUTES.add(telethon.types.DocumentAttributeFilename, "file_name")
+DOCUMENT_ATTRIBUTES.add(telethon.types.DocumentAttributeSticker, "sticker")
+DOCUMENT_ATTRIBUTES.add(telethon.types.DocumentAttributeAudio, "audio")
+DOCUMENT_ATTRIBUTES.add(telethon.types.DocumentAttributeImageSize, "image")
+DOCUMENT_ATTRIBUTES.add(telethon.types.DocumentAttributeVideo, "video")
 
-    elif isinstance(tl, telethon.types.MessageMediaDocument):
-        return await TelegramDocument.from_tl(tl.document, caller=caller)
 
-    elif isinstance(tl, telethon.types.MessageMediaGeo) or isinstance(tl, telethon.types.MessageMediaGeoLive):
-        return await TelegramGeoPoint.from_tl(tl.geo, caller=caller)
+@ATTACHMENTS.register(telethon.types.MessageMediaPhoto)
+async def _photo(tl: telethon.types.MessageMediaPhoto, caller: Interface):
+    return await TelegramPhoto.from_tl(tl.photo, caller=caller)
 
-    elif isinstance(tl, telethon.types.MessageMediaVenue):
-        return await TelegramVenue.from_tl(tl, caller=caller)
 
-    elif isinstance(tl, telethon.types.MessageMediaContact):
-        return await TelegramContact.from_tl(tl, caller=caller)
+@ATTACHMENTS.register(telethon.types.MessageMediaDocument)
+async def _document(tl: telethon.types.MessageMediaDocument, caller: Interface):
+    return await TelegramDocument.from_tl(tl.document, caller=caller)
 
-    else:
-        logging.warning(f"Неизвестный или неподдерживаемый тип вложений: {type(tl)}")
-        return types.Unsupported(
-            0,
-            source=tl,
-            caller=caller
-        )
+
+@ATTACHMENTS.register(telethon.types.MessageMediaGeo, telethon.types.MessageMediaGeoLive)
+async def _geo(tl: telethon.types.MessageMediaGeo | telethon.types.MessageMediaGeoLive, caller: Interface):
+    return await TelegramGeoPoint.from_tl(tl.geo, caller=caller)
+
+
+ATTACHMENTS.register(telethon.types.MessageMediaPoll)(TelegramPoll.from_tl)
+ATTACHMENTS.register(telethon.types.MessageMediaVenue)(TelegramVenue.from_tl)
+ATTACHMENTS.register(telethon.types.MessageMediaContact)(TelegramContact.from_tl)
+
+
+async def process_attachment(tl: TLObject, caller: Interface) -> types.Attachment:
+    converter = ATTACHMENTS.lookup(tl)
+    if converter:
+        with tracer.span("from_tl", type(tl).__name__):
+            return await converter(tl, caller=caller)
+
+    if ATTACHMENTS.unknown[type(tl).__name__] == 1:
+        logging.warning("Неизвестный или неподдерживаемый тип вложений: %s", type(tl))
+    return types.Unsupported(
+        0,
+        source=tl,
+        caller=caller
+    )
+
+
+def photo_size(tl: telethon.types.Photo) -> int:
+    largest = tl.sizes[-1]
+    if isinstance(largest, telethon.types.PhotoSizeProgressive):
+        return max(largest.sizes)
+    return getattr(largest, "size", 0)
+
+
+def document_attributes(tl: telethon.types.Document) -> dict[str, TLObject]:
+    """
+    Известные атрибуты документа по названию: file_name, sticker, audio, image, video.
+    """
+    result = {}
+    for attr in tl.attributes:
+        name = DOCUMENT_ATTRIBUTES.get(type(attr))
+        if name:
+            result[name] = attr
+    return result
+
+
+def document_kind(tl: telethon.types.Document) -> types.AttachmentKind:
+    attributes = document_attributes(tl)
+    if "sticker" in attributes:
+        return types.AttachmentKind.ANIMATED_STICKER if "video" in attributes else types.AttachmentKind.STICKER
+    elif "video" in attributes:
+        return types.AttachmentKind.VIDEO
+    elif "audio" in attributes:
+        return types.AttachmentKind.AUDIO
+    return types.AttachmentKind.DOCUMENT
+
+
+# Дешёвые метаданные вложения: (тип, ID, размер)
+ATTACHMENT_INFO.add(telethon.types.MessageMediaPhoto, lambda tl: (
+    (types.AttachmentKind.PHOTO, tl.photo.id, photo_size(tl.photo)) if tl.photo
+    else (types.AttachmentKind.UNSUPPORTED, 0, None)
+))
+ATTACHMENT_INFO.add(telethon.types.MessageMediaDocument, lambda tl: (
+    (document_kind(tl.document), tl.document.id, tl.document.size) if tl.document
+    else (types.AttachmentKind.UNSUPPORTED, 0, None)
+))
+ATTACHMENT_INFO.add(telethon.types.MessageMediaPoll, lambda tl: (types.AttachmentKind.POLL, tl.poll.id, None))
+ATTACHMENT_INFO.add(telethon.types.MessageMediaGeo, lambda tl: (types.AttachmentKind.GEO, 0, None))
+ATTACHMENT_INFO.add(telethon.types.MessageMediaGeoLive, lambda tl: (types.AttachmentKind.GEO, 0, None))
+ATTACHMENT_INFO.add(telethon.types.MessageMediaVenue, lambda tl: (types.AttachmentKind.VENUE, 0, None))
+ATTACHMENT_INFO.add(telethon.types.MessageMediaContact, lambda tl: (types.AttachmentKind.CONTACT, tl.user_id, None))
+
+
+def lazy_attachment(tl: TLObject, caller: Interface) -> types.LazyAttachment:
+    """
+    Собирает дешёвые метаданные вложения без запросов к API, само вложение преобразуется при первом await.
+    """
+    info = ATTACHMENT_INFO.get(type(tl))
+    kind, id, size = info(tl) if info else (types.AttachmentKind.UNSUPPORTED, 0, None)
+
+    return types.LazyAttachment(
+        id=id,
+        kind=kind,
+        file_size=size,
+        factory=lambda: process_attachment(tl, caller=caller),
+        source=tl,
+        caller=caller
+    )
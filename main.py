@@ -1,57 +1,153 @@
-import asyncio
-import importlib
-import os
-from typing import Any
-
-from interfaces.base import Interface, BaseInterface
-
-DIRECTORY = "interfaces"
-
-
-def load_interfaces(base_interface: BaseInterface, directory=DIRECTORY):
-    results = []
-
-    # Проходим по всем папкам в указанной директории
-    for root, dirs, files in os.walk(directory):
-        # Ищем каталоги с __init__.py
-        if '__init__.py' in files and root != directory:
-            # Определяем модульное имя по пути
-            module_name = os.path.relpath(root, os.getcwd()).replace(os.sep, '.')
-
-            try:
-                # Импортируем модуль
-                module = importlib.import_module(module_name)
-
-                # Проверяем наличие метода get
-                if hasattr(module, 'get') and callable(getattr(module, 'get')):
-                    # Вызываем метод get и добавляем результат в список
-                    class_ = module.get()
-                    results.append(class_(base_interface))
-
-            except Exception as e:
-                print(f"Ошибка при импорте модуля {module_name}: {e}")
-
-    return results
-
-
-async def async_start(interfaces: list[Interface]):
-    coroutines = [i.start() for i in interfaces]
-    await asyncio.gather(*coroutines)
-
-
-if __name__ == '__main__':
-    # Запуск ядра
-
-    base = BaseInterface(None)
-    interfaces: list[Any] = load_interfaces(base)
-    # print(interfaces)
-
-    coro = async_start(interfaces)
-    for i in interfaces:
-        # Костыль
-        if i.__class__.__name__ == "TelegramInterface":
-            with i.client:
-                i.client.loop.run_until_complete(coro)
-                break
-    else:
-        asyncio.run(coro)
+import asyncio
+import contextlib
+import functools
+import importlib
+import importlib.metadata
+import logging
+import os
+import time
+from typing import Callable
+
+from interfaces.base import Interface, BaseInterface, ShardedDispatcher, StateStore, Storage, Supervisor
+from interfaces.base.supervisor import run
+
+# Сторонние пакеты добавляют интерфейсы через entry points этой группы, значение - класс интерфейса
+ENTRY_POINT_GROUP = "multiinterfacesbot.interfaces"
+# Встроенные интерфейсы: название -> модуль с функцией get()
+MANIFEST = {
+    "telegram": "interfaces.telegram",
+}
+# Количество процессов-обработчиков, 0 - обработка в этом же процессе
+SHARDS = int(os.getenv("SHARDS", "0"))
+DB_PATH = os.getenv("DB_PATH", "bot.db")
+STATE_PATH = os.getenv("STATE_PATH", "states.json")
+
+
+class StartupTimings:
+    def __init__(self):
+        """
+        Время этапов запуска (импорт, создание, подключение) по интерфейсам.
+        """
+        self.phases: dict[str, float] = {}
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - started
+
+    def __str__(self):
+        return ", ".join(f"{name}: {seconds:.3f} с" for name, seconds in self.phases.items())
+
+
+def available_interfaces() -> dict[str, Callable[[], type[Interface]]]:
+    """
+    Все известные интерфейсы без их импорта: название -> функция, возвращающая класс.
+    """
+    loaders = {name: (lambda module=module: importlib.import_module(module).get()) for name, module in MANIFEST.items()}
+    for entry_point in importlib.metadata.entry_points(group=ENTRY_POINT_GROUP):
+        loaders[entry_point.name] = entry_point.load
+    return loaders
+
+
+def enabled_interfaces(available: dict[str, Callable]) -> list[str]:
+    """
+    Интерфейсы из переменной окружения INTERFACES (через запятую), по умолчанию - все.
+    """
+    value = os.getenv("INTERFACES")
+    if not value:
+        return list(available)
+    names = [name.strip().lower() for name in value.split(",") if name.strip()]
+    for name in names:
+        if name not in available:
+            logging.error("Неизвестный интерфейс %s, доступны: %s", name, ", ".join(available))
+    return [name for name in names if name in available]
+
+
+def load_interfaces(base_interface: BaseInterface, names: list[str] = None,
+                    timings: StartupTimings = None) -> list[Interface]:
+    """
+    Импортирует и создаёт только включённые интерфейсы. Подключение к платформам - в async_start.
+    :param base_interface: Ядро
+    :param names: Названия интерфейсов, по умолчанию из enabled_interfaces
+    :param timings: Куда записать время импорта и создания
+    """
+    timings = timings or StartupTimings()
+    available = available_interfaces()
+    results = []
+    for name in names if names is not None else enabled_interfaces(available):
+        try:
+            with timings.phase(f"{name}.import"):
+                class_ = available[name]()
+            with timings.phase(f"{name}.init"):
+                results.append(class_(base_interface))
+        except Exception as e:
+            logging.error("Ошибка при загрузке интерфейса %s: %s", name, e)
+    return results
+
+
+async def async_start(interfaces: list[Interface], timings: StartupTimings = None,
+                      supervisor: Supervisor = None) -> Supervisor:
+    """
+    Подключает интерфейсы одновременно и запускает их под наблюдением супервизора.
+    Не подключившиеся тоже запускаются - супервизор повторит подключение с задержкой.
+    """
+    timings = timings or StartupTimings()
+    supervisor = supervisor or Supervisor()
+
+    async def connect(interface: Interface):
+        with timings.phase(f"{type(interface).__name__}.connect"):
+            await interface.connect()
+
+    # Подключение и авторизация всех интерфейсов идут одновременно
+    with timings.phase("connect"):
+        results = await asyncio.gather(*(connect(i) for i in interfaces), return_exceptions=True)
+    logging.info("Запуск: %s", timings)
+
+    for interface, result in zip(interfaces, results):
+        connected = not isinstance(result, Exception)
+        if not connected:
+            logging.error("Не удалось подключить %s: %s", type(interface).__name__, result)
+
+        def runner(interface=interface, connected=connected):
+            async def run_interface():
+                nonlocal connected
+                # Первый запуск уже подключён, после падения подключаемся заново
+                if not connected:
+                    await interface.connect()
+                connected = False
+                await interface.start()
+
+            return run_interface
+
+        supervisor.supervise(interface, runner())
+    return supervisor
+
+
+async def main():
+    # Клиенты платформ создаются уже внутри цикла событий, которым потом пользуются
+    timings = StartupTimings()
+    storage = Storage(DB_PATH)
+    base = BaseInterface(storage, StateStore(path=STATE_PATH))
+    if SHARDS:
+        # Интерфейсы остаются здесь, обработчики команд - в отдельных процессах
+        # Воркеры читают ту же базу (WAL), пишет только этот процесс
+        base.dispatcher = ShardedDispatcher(processes=SHARDS,
+                                            user_db_factory=functools.partial(Storage, DB_PATH, readonly=True),
+                                            downloader=base._download, states=base.states)
+    interfaces = load_interfaces(base, timings=timings)
+    supervisor = await async_start(interfaces, timings, Supervisor(base))
+    try:
+        await supervisor.wait()
+    finally:
+        await base.states.close()
+        await base.media_store.close()
+        await storage.close()
+
+
+if __name__ == '__main__':
+    # Запуск ядра
+    logging.basicConfig(level=logging.INFO)
+    run(main())